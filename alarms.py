@@ -0,0 +1,188 @@
+"""
+    alarms.py
+    Threshold and rate-of-change alarms evaluated on the station
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    Rules are read from a JSON file holding a list of objects such as:
+
+        {"name": "frost", "uuid": "a0ce0210-...", "kind": "below",
+         "limit": 0.0, "hysteresis": 0.5}
+        {"name": "falling pressure", "uuid": "a0ce0212-...",
+         "kind": "rate_below", "limit": -1.0, "hysteresis": 0.3,
+         "window": 3600}
+
+    kind is one of:
+
+        above, below            the reading itself against limit
+        rate_above, rate_below  the change per hour, measured over at least
+                                window seconds (default 3600)
+
+    Rates are measured over a sliding window. Each rule keeps one sample per
+    window / RATE_SLOTS seconds, and every reading is compared with the
+    newest sample that is at least window old, so a rate alarm fires on the
+    reading that crosses the limit.
+
+    An alarm is raised when the value crosses limit and only cleared once it
+    has come back past limit by hysteresis, so a reading hovering at the
+    limit doesn't flap. The value reported with an alarm is the one compared
+    with limit, so for a rate rule it is the change per hour.
+
+    Rules are indexed by channel and keep a constant amount of state, so each
+    reading costs the same however many rules other channels have.
+"""
+
+import json
+import time
+import logging
+
+from collections import deque
+
+KINDS                               = ('above','below','rate_above','rate_below')
+DEFAULT_WINDOW_SECONDS              = 3600
+# Samples kept per rate window, the rate is measured over between window and
+# window * (1 + 1 / RATE_SLOTS) seconds
+RATE_SLOTS                          = 16
+HISTORY_SIZE                        = 256
+
+log = logging.getLogger(__name__)
+
+
+class AlarmEvent(object):
+
+    __slots__ = ('timestamp','name','uuid','raised','value')
+
+    def __init__(self,timestamp,name,uuid,raised,value):
+        self.timestamp = timestamp
+        self.name = name
+        self.uuid = uuid
+        self.raised = raised
+        self.value = value
+
+    # The form sent to clients, e.g. 'raised:frost:-0.30'
+    def to_bytes(self):
+        state = 'raised' if True == self.raised else 'cleared'
+        return ('%s:%s:%.2f' % (state,self.name,self.value)).encode('utf-8')
+
+    def __str__(self):
+        state = 'raised' if True == self.raised else 'cleared'
+        return '%s %s %s (%s = %.2f)' % (time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(self.timestamp)),self.name,state,self.uuid,self.value)
+
+
+class Rule(object):
+
+    __slots__ = ('name','uuid','kind','limit','hysteresis','window','active','slot_seconds','last_slot','samples')
+
+    def __init__(self,name,uuid,kind,limit,hysteresis=0.0,window=DEFAULT_WINDOW_SECONDS):
+        if kind not in KINDS:
+            raise ValueError('Unknown alarm kind: ' + str(kind))
+        self.name = name
+        self.uuid = uuid
+        self.kind = kind
+        self.limit = float(limit)
+        self.hysteresis = abs(float(hysteresis))
+        self.window = float(window)
+        self.active = False
+        self.slot_seconds = self.window / RATE_SLOTS
+        self.last_slot = None
+        # (timestamp,value), one per slot, oldest first. Enough room for a
+        # full window of slots plus the reference sample before them.
+        self.samples = deque(maxlen=RATE_SLOTS + 2)
+
+    # Returns the value this rule compares, or None if there isn't one yet
+    def measure(self,timestamp,value):
+        if 'above' == self.kind or 'below' == self.kind:
+            return value
+        slot = int(timestamp // self.slot_seconds)
+        if slot != self.last_slot:
+            self.samples.append((timestamp,value))
+            self.last_slot = slot
+        # Keep samples[0] the newest sample at least a window old
+        while len(self.samples) > 1 and (timestamp - self.samples[1][0]) >= self.window:
+            self.samples.popleft()
+        ref_time,ref_value = self.samples[0]
+        elapsed = timestamp - ref_time
+        if elapsed < self.window:
+            return None
+        return ((value - ref_value) / elapsed) * 3600
+
+    # Returns (True,measured) if the alarm was raised, (False,measured) if
+    # cleared, else None
+    def evaluate(self,timestamp,value):
+        x = self.measure(timestamp,value)
+        if None is x:
+            return None
+        high = self.kind.endswith('above')
+        if False == self.active:
+            if (True == high and x > self.limit) or (False == high and x < self.limit):
+                self.active = True
+                return (True,x)
+        else:
+            if (True == high and x < (self.limit - self.hysteresis)) or (False == high and x > (self.limit + self.hysteresis)):
+                self.active = False
+                return (False,x)
+        return None
+
+
+class AlarmEngine(object):
+
+    def __init__(self):
+        self.rules = dict()
+        self.history = deque(maxlen=HISTORY_SIZE)
+
+    def add_rule(self,rule):
+        if rule.uuid not in self.rules:
+            self.rules[rule.uuid] = list()
+        self.rules[rule.uuid].append(rule)
+
+    def load_rules(self,path):
+        with open(path) as f:
+            for x in json.load(f):
+                self.add_rule(Rule(x['name'],x['uuid'],x['kind'],x['limit'],
+                                   x.get('hysteresis',0.0),x.get('window',DEFAULT_WINDOW_SECONDS)))
+        log.info('Loaded ' + str(self.get_rule_count()) + ' alarm rules from ' + path)
+
+    def get_rule_count(self):
+        return sum([len(x) for x in self.rules.values()])
+
+    # Returns a list of AlarmEvents, usually empty
+    def evaluate(self,uuid,value,timestamp):
+        rv = list()
+        rules = self.rules.get(uuid)
+        if None is rules:
+            return rv
+        try:
+            value = float(value)
+        except (TypeError,ValueError):
+            return rv
+        for rule in rules:
+            result = rule.evaluate(timestamp,value)
+            if None is not result:
+                state,measured = result
+                event = AlarmEvent(timestamp,rule.name,uuid,state,measured)
+                self.history.append(event)
+                log.warning('Alarm ' + str(event))
+                rv.append(event)
+        return rv
+
+    def get_active(self):
+        rv = list()
+        for rules in self.rules.values():
+            for rule in rules:
+                if True == rule.active:
+                    rv.append(rule.name)
+        return rv
@@ -24,18 +24,32 @@
 
 """
 
+import sys
+
+# Must come before everything else so the imports below are measured
+if '--profile-startup' in sys.argv:
+    import startup_profile
+    startup_profile.install()
+else:
+    startup_profile = None
 
 import os
-import argparse
+import time
 import trio
+import signal
 import logging
-import platform
-import xml.etree.ElementTree as et
 
 from jeepney import DBusAddress
+from jeepney import MatchRule
+from jeepney import MessageType
+from jeepney import HeaderFields
+from jeepney import new_error
+from jeepney import new_signal
+from jeepney import new_method_return
 from jeepney import new_method_call
 from jeepney.wrappers import Introspectable
 from jeepney.wrappers import DBusErrorResponse
+from jeepney.wrappers import unwrap_msg
 import jeepney.io.trio
 
 import dbus_objects
@@ -50,6 +64,13 @@ from collections import defaultdict
 
 from importlib import import_module
 
+# alarms, link_test, memory_budget and sampling_profiler are only imported
+# when the options that need them are given
+import history
+import loop_monitor
+import push_plugins
+import sample_pipeline
+
 import bluez_dbus
 from bluez_dbus import Adapter
 from bluez_dbus import DBUS_NAME 
@@ -73,6 +94,10 @@ from bluez_dbus import DBUS_PEER_INTERFACE
 
 ADVERT_LABEL                        = 'advertisement'
 AGENT_LABEL                         = 'agent'
+ALARM_LABEL                         = 'alarm'
+HISTORY_LABEL                       = 'history'
+LINK_SINK_LABEL                     = 'link_sink'
+LINK_SOURCE_LABEL                   = 'link_source'
 APP_LABEL                           = 'application'
 HUMIDITY_LABEL                      = 'humidity'
 PRESSURE_LABEL                      = 'pressure'
@@ -94,12 +119,34 @@ CCS_SERVICE_ID_UUID                 = 'a0ce0201-3bbf-11ee-89eb-00e04c400cc5'
 CCS_AIR_TEMPERATURE_UUID            = 'a0ce0210-3bbf-11ee-89eb-00e04c400cc5'
 CCS_HUMIDITY_UUID                   = 'a0ce0211-3bbf-11ee-89eb-00e04c400cc5'
 CCS_AIR_PRESSURE_UUID               = 'a0ce0212-3bbf-11ee-89eb-00e04c400cc5'
+CCS_ALARM_UUID                      = 'a0ce0220-3bbf-11ee-89eb-00e04c400cc5'
+CCS_HISTORY_UUID                    = 'a0ce0230-3bbf-11ee-89eb-00e04c400cc5'
+CCS_LINK_SINK_UUID                  = 'a0ce02f0-3bbf-11ee-89eb-00e04c400cc5'
+CCS_LINK_SOURCE_UUID                = 'a0ce02f1-3bbf-11ee-89eb-00e04c400cc5'
 
 
 SHARED_OBJECT_DIR                   = 'plugins'
 
+DBUS_INVALID_ARGS_ERROR             = 'org.freedesktop.DBus.Error.InvalidArgs'
+DBUS_FAILED_ERROR                   = 'org.freedesktop.DBus.Error.Failed'
+BLUEZ_ALREADY_EXISTS_ERROR          = 'org.bluez.Error.AlreadyExists'
+
 DEFAULT_UPDATE_SECONDS              = 10
 
+# Reconnect backoff, doubled after every failed attempt
+RECONNECT_MIN_SECONDS               = 0.25
+RECONNECT_MAX_SECONDS               = 5
+
+# How long to wait for BlueZ to answer a registration call
+BLUEZ_CALL_TIMEOUT_SECONDS          = 10
+
+WORKER_CHECK_SECONDS                = 1
+
+ALARM_QUEUE_SIZE                    = 64
+HISTORY_SAVE_SECONDS                = 900
+# Longest history query accepted over BLE
+HISTORY_MAX_QUERY_BYTES             = 512
+
 g_hci = None
 
 logging.basicConfig(filename='/tmp/data_station.log')
@@ -114,23 +161,61 @@ class NoBluetoothAdapter(Exception):
 # Based on dbus_objects.integration.jeepney.TrioDBusServer
 class CcsServer(dbus_objects.integration.jeepney._JeepneyServerBase):
 
-    def __init__(self,bus,name) -> None:
+    def __init__(self,bus,name,isolate_plugins=False,memory_budget=False) -> None:
         super().__init__(bus,name)
+        # (path,interface,member) -> (method,input signature,output signature)
+        self.dispatch = dict()
         self.open = False
+        self.running = True
+        self.nursery = None
         self.application = None
         self.application_registered = False
+        self.agent_registered = False
+        self.advertisement_registered = False
         self.agent = None
         self.plugins = None
+        self.workers = None
+        self.push_plugins = None
+        self.sample_send,self.sample_receive = trio.open_memory_channel(push_plugins.QUEUE_SIZE)
+        self.pipeline = None
+        self.isolate_plugins = isolate_plugins
+        self.memory_budget = memory_budget
         self.most_recent_data = None
         self.dbus_ready = False
         self.update_seconds = DEFAULT_UPDATE_SECONDS
+        self.outage_start = None
+        # Readings collected while BlueZ couldn't reach us. They still go to
+        # the history tiers and the exporter, so only the count is kept.
+        self.outage_readings = 0
+        self.last_recovery_seconds = None
+        # serial -> [trio.Event,reply] for calls waiting on a reply
+        self.pending_replies = dict()
+        # Bumped by every register_with_bluez, so a stale one stops retrying
+        self.registration = 0
+        self.interface = None
+        self.loop_monitor = loop_monitor.LoopMonitor()
+        self.exporter = None
+        # Set up by app() when there are alarm rules
+        self.alarms = None
+        self.alarm_characteristic = None
+        self.alarm_send,self.alarm_receive = trio.open_memory_channel(ALARM_QUEUE_SIZE)
+        # Set up by app() with --link-test
+        self.link_test = None
+        # Created by the first start_profile()
+        self.profiler = None
+        self.link_source = None
+        self.link_source_scope = None
+        # Created by allocate_storage()
+        self.history = None
+        self.history_file = None
+        self.allocate_storage()
         self.load_plugins()
         self._logger = logging.getLogger(self.__class__.__name__)
 
     # dbus_objects method for an async initialization function
     @classmethod
-    async def new(cls,bus: str,name: str):
-        inst = cls(bus,name)
+    async def new(cls,bus: str,name: str,isolate_plugins: bool = False,memory_budget: bool = False):
+        inst = cls(bus,name,isolate_plugins,memory_budget)
         await inst._conn_start()
         inst.register_dbus_advertisement()
         inst.register_dbus_agent()
@@ -144,34 +229,150 @@ class CcsServer(dbus_objects.integration.jeepney._JeepneyServerBase):
                 try:
                     bus_proxy = jeepney.io.trio.Proxy(jeepney.message_bus,router)
                     await bus_proxy.RequestName(self._name)
+                    # Lets rx notice bluetoothd restarting underneath us
+                    rule = MatchRule(type='signal',sender=DBUS_NAME,interface=DBUS_INTERFACE,
+                                     member='NameOwnerChanged',path=DBUS_PATH)
+                    rule.add_arg_condition(0,BLUEZ_BUS_NAME)
+                    await bus_proxy.AddMatch(rule)
                     self.open = True
                 except DBusErrorResponse as e:
                     log.error('[_conn_start] Error opening router: ' + str(e))
 
     async def _handle_msg(self,msg: jeepney.Message) -> None:
         log.debug('[_handle_msg] msg: ' + str(msg))
-        return_msg = self._jeepney_handle_msg(msg)
+        if MessageType.signal == msg.header.message_type:
+            await self._handle_signal(msg)
+            return
+        if msg.header.message_type in (MessageType.method_return,MessageType.error):
+            self.handle_reply(msg)
+            return
+        return_msg = self.dispatch_msg(msg)
         if None is not return_msg:
             log.debug('[_handle_msg] returning msg: ' + str(return_msg))
             await self._conn.send(return_msg)
 
+    # Does what _jeepney_handle_msg does, but with one dict lookup instead of
+    # walking the method tree, and with the signatures worked out up front.
+    # Anything not in the index, such as the standard interfaces dbus_objects
+    # adds itself, still goes through _jeepney_handle_msg.
+    def dispatch_msg(self,msg: jeepney.Message) -> Optional[jeepney.Message]:
+        if MessageType.method_call != msg.header.message_type:
+            return self._jeepney_handle_msg(msg)
+        fields = msg.header.fields
+        key = (fields.get(HeaderFields.path),fields.get(HeaderFields.interface),fields.get(HeaderFields.member))
+        entry = self.dispatch.get(key)
+        if None is entry:
+            return self._jeepney_handle_msg(msg)
+        method,signature_input,signature_output = entry
+        if signature_input != fields.get(HeaderFields.signature,''):
+            return new_error(msg,DBUS_INVALID_ARGS_ERROR,'s',('Invalid signature, expected ' + signature_input,))
+        try:
+            rv = method(*msg.body)
+        except Exception as e:
+            log.exception('[dispatch_msg] ' + str(key))
+            return new_error(msg,DBUS_FAILED_ERROR,'s',(type(e).__name__ + ': ' + str(e),))
+        return new_method_return(msg,signature_output,(rv,) if None is not rv else tuple())
+
+    def register_object(self,path: str,obj: dbus_objects.DBusObject) -> None:
+        super().register_object(path,obj)
+        for method,descriptor in obj.get_dbus_methods():
+            key = (path,descriptor.interface,descriptor.name)
+            # First registration wins, as it does in the dbus_objects tree
+            if key not in self.dispatch:
+                signature_input,signature_output = descriptor.signature
+                self.dispatch[key] = (method,signature_input,signature_output)
+
+    def handle_reply(self,msg: jeepney.Message) -> None:
+        waiter = self.pending_replies.get(msg.header.fields.get(HeaderFields.reply_serial))
+        if None is not waiter:
+            waiter[1] = msg
+            waiter[0].set()
+
+    # Sends a method call and waits for the reply, which rx hands over. A
+    # router can't be used for this: it would take the incoming messages,
+    # and BlueZ calls GetManagedObjects on us before answering
+    # RegisterApplication. Raises DBusErrorResponse if the call failed.
+    async def call(self,msg: jeepney.Message) -> tuple:
+        serial = next(self._conn.outgoing_serial)
+        waiter = [trio.Event(),None]
+        self.pending_replies[serial] = waiter
+        try:
+            await self._conn.send(msg,serial=serial)
+            with trio.fail_after(BLUEZ_CALL_TIMEOUT_SECONDS):
+                await waiter[0].wait()
+        finally:
+            del self.pending_replies[serial]
+        return unwrap_msg(waiter[1])
+
+    async def _handle_signal(self,msg: jeepney.Message) -> None:
+        if 'NameOwnerChanged' != msg.header.fields.get(HeaderFields.member):
+            return
+        name,old_owner,new_owner = msg.body
+        if BLUEZ_BUS_NAME != name:
+            return
+        if '' == new_owner:
+            log.warning('[_handle_signal] bluetoothd went away')
+            self.start_outage()
+        else:
+            log.info('[_handle_signal] bluetoothd is back as ' + new_owner + ', re-registering')
+            self.start_outage()
+            self.nursery.start_soon(self.register_with_bluez)
+
     async def emit_signal(self,signal: dbus_objects._DBusSignal,path: str,body: Any) -> None:
         await self._conn.send_message(self._get_signal_msg(signal,path,body))
 
     async def close(self) -> None:
+        self.running = False
+        for worker in self.workers:
+            worker.stop()
+        if None is not self.exporter:
+            self.exporter.flush()
+        if None is not self.history_file:
+            self.history.save(self.history_file)
         if self.open: 
             self.open = False
 
     async def rx(self) -> None:
-        while True == self.open:
+        while True == self.running:
             try:
                 msg = await self._conn.receive()
-            except ConnectionResetError:
-                self.open = False
-                await self._conn_start()
+            except (ConnectionResetError,trio.EndOfChannel,trio.BrokenResourceError):
+                await self.reconnect()
             else:
                 await self._handle_msg(msg)
 
+    # BlueZ forgets our registrations when either side goes away
+    def start_outage(self) -> None:
+        self.dbus_ready = False
+        self.application_registered = False
+        self.agent_registered = False
+        self.advertisement_registered = False
+        if None is self.outage_start:
+            self.outage_start = time.monotonic()
+
+    async def reconnect(self) -> None:
+        log.warning('[reconnect] Lost the D-Bus connection')
+        self.open = False
+        self.start_outage()
+        try:
+            await self._conn.aclose()
+        except Exception:
+            pass
+
+        delay = RECONNECT_MIN_SECONDS
+        while True == self.running and False == self.open:
+            try:
+                await self._conn_start()
+            except OSError as e:
+                log.error('[reconnect] ' + str(e))
+            if False == self.open:
+                await trio.sleep(delay)
+                delay = min(delay * 2,RECONNECT_MAX_SECONDS)
+
+        # Our objects are still registered locally, only BlueZ needs telling again
+        if True == self.open:
+            self.nursery.start_soon(self.register_with_bluez)
+
     async def register_bluez_agent(self) -> None:
         path = bluez_dbus.BLUEZ_PATH
         name = bluez_dbus.BLUEZ_BUS_NAME
@@ -183,8 +384,8 @@ class CcsServer(dbus_objects.integration.jeepney._JeepneyServerBase):
         log.info('Registering agent at: ' + str(agent_name))
         addr = DBusAddress(path,bus_name=name,interface=bluez_dbus.LE_AGENT_MANAGER_INTERFACE)
         msg = new_method_call(addr,'RegisterAgent','os',(agent_name,"NoInputNoOutput"))
-        async with self._conn.router() as rtr:
-            await rtr.send(msg);
+        await self.call_register(msg)
+        self.agent_registered = True
 
 
     async def register_bluez_application(self) -> None:
@@ -194,8 +395,7 @@ class CcsServer(dbus_objects.integration.jeepney._JeepneyServerBase):
 
         log.info('Registering application at ' + CCS_DATA_ROOT)
         msg = new_method_call(addr,'RegisterApplication','oa{sv}',(CCS_DATA_ROOT,{}))
-        async with self._conn.router() as rtr:
-            await rtr.send(msg);
+        await self.call_register(msg)
         self.application_registered = True
 
     async def register_bluez_advertisement(self) -> None:
@@ -214,33 +414,208 @@ class CcsServer(dbus_objects.integration.jeepney._JeepneyServerBase):
         path = bluez_dbus.BLUEZ_PATH + '/' + g_hci
         addr = DBusAddress(path,bus_name=name,interface=bluez_dbus.LE_ADVERTISING_MANAGER_INTERFACE)
         msg = new_method_call(addr,'RegisterAdvertisement','oa{sv}',(ad_name,{}))
-        async with self._conn.router() as rtr:
-            await rtr.send(msg);
+        await self.call_register(msg)
+        self.advertisement_registered = True
 
+    # A call that timed out may still have been accepted, in which case
+    # BlueZ answers the retry with AlreadyExists
+    async def call_register(self,msg) -> None:
+        try:
+            await self.call(msg)
+        except DBusErrorResponse as e:
+            if BLUEZ_ALREADY_EXISTS_ERROR != e.name:
+                raise
+            log.info('[call_register] ' + str(msg.header.fields.get(HeaderFields.member)) + ': already registered')
+
+    # Used both at startup and to restore everything after an outage. A
+    # restarted bluetoothd takes the bus name before the adapter is back, so
+    # failed calls are retried with backoff until BlueZ accepts all three.
+    # Steps that already succeeded aren't repeated.
+    async def register_with_bluez(self) -> None:
+        self.registration += 1
+        registration = self.registration
+        delay = RECONNECT_MIN_SECONDS
+        while True == self.running and registration == self.registration:
+            try:
+                if None is not self.outage_start:
+                    # bluetoothd comes back with the adapter powered off
+                    await setup_adapter(self.interface)
+                if False == self.application_registered:
+                    await self.register_bluez_application()
+                if False == self.agent_registered:
+                    await self.register_bluez_agent()
+                if False == self.advertisement_registered:
+                    await self.register_bluez_advertisement()
+                break
+            except (OSError,trio.BrokenResourceError,trio.ClosedResourceError) as e:
+                # rx will notice the dead connection and schedule another attempt
+                log.error('[register_with_bluez] ' + str(e))
+                return
+            except (DBusErrorResponse,NoBluetoothAdapter,RuntimeError,trio.TooSlowError) as e:
+                log.warning('[register_with_bluez] BlueZ not ready (%s), retrying in %.2f seconds',str(e) or type(e).__name__,delay)
+            await trio.sleep(delay)
+            delay = min(delay * 2,RECONNECT_MAX_SECONDS)
+        if registration != self.registration or False == self.running:
+            return
+        self.dbus_ready = True
+        if None is not startup_profile:
+            startup_profile.milestone('advertising registered')
+            startup_profile.report()
+        if None is not self.outage_start:
+            self.last_recovery_seconds = time.monotonic() - self.outage_start
+            self.outage_start = None
+            log.info('Recovered in %.2f seconds, %d readings collected during the outage',
+                     self.last_recovery_seconds,self.outage_readings)
+            self.outage_readings = 0
+
+    def store_reading(self,uuid,value,timestamp=None) -> None:
+        if None is timestamp:
+            timestamp = time.time()
+        self.most_recent_data[uuid] = value
+        self.history.add(uuid,value,timestamp)
+        if False == self.dbus_ready and None is not self.outage_start:
+            self.outage_readings += 1
+        if None is self.alarms:
+            return
+        for event in self.alarms.evaluate(uuid,value,timestamp):
+            try:
+                self.alarm_send.send_nowait(event)
+            except trio.WouldBlock:
+                log.error('[store_reading] Alarm queue full, not indicating ' + event.name)
+
+    # Sends a PropertiesChanged signal for the characteristic's Value, which
+    # BlueZ turns into a notification or indication to subscribed clients.
+    # Returns False if there was nobody to send it to.
+    async def notify_value(self,sensor,payload) -> bool:
+        if True == self.open and True == sensor.notifying:
+            addr = DBusAddress(sensor.get_path(),interface=DBUS_PROPERTIES_INTERFACE)
+            msg = new_signal(addr,'PropertiesChanged','sa{sv}as',(GATT_CHARACTERISTIC_INTERFACE,{'Value': ('ay',payload)},[]))
+            await self._conn.send(msg)
+            return True
+        return False
+
+    # A new START replaces a run that is still going, two at once would
+    # send the same sequence numbers
+    def start_link_source(self,size,count,interval) -> None:
+        if None is not self.link_source and None is not self.nursery:
+            if None is not self.link_source_scope:
+                self.link_source_scope.cancel()
+            self.link_source_scope = trio.CancelScope()
+            self.nursery.start_soon(self.run_link_source,size,count,interval,self.link_source_scope)
+
+    async def run_link_source(self,size,count,interval,scope) -> None:
+        with scope:
+            log.info('Link test: sending %d packets of %d bytes' % (count,size))
+            for seq in range(count):
+                if False == self.link_source.notifying:
+                    break
+                try:
+                    sent = await self.notify_value(self.link_source,self.link_test.make_packet(seq,size))
+                except (OSError,trio.BrokenResourceError,trio.ClosedResourceError) as e:
+                    log.error('[run_link_source] ' + str(e))
+                    break
+                if False == sent:
+                    break
+                self.link_test.note_sent(seq,size)
+                # Still yield between packets when the interval is zero
+                await trio.sleep(interval)
+        if scope is self.link_source_scope:
+            self.link_source_scope = None
+
+    # Returns the path the collapsed stacks will be written to
+    def start_profile(self,seconds) -> str:
+        if None is self.profiler:
+            import sampling_profiler
+            # Labels samples with whatever task the loop monitor saw running
+            self.profiler = sampling_profiler.SamplingProfiler(lambda: self.loop_monitor.instrument.current)
+        return self.profiler.start(seconds)
+
+    async def publish_alarms(self) -> None:
+        async for event in self.alarm_receive:
+            try:
+                await self.notify_value(self.alarm_characteristic,event.to_bytes())
+            except (OSError,trio.BrokenResourceError,trio.ClosedResourceError) as e:
+                log.error('[publish_alarms] ' + str(e))
 
     async def collect_latest(self) -> None:
+        cycle = list()
         for plugin in self.plugins:
-            data = plugin.get_current_values()
+            data = sample_pipeline.plugin_values(plugin,self.pipeline)
             for x in data:
                 if 2 == len(x):
-                    self.most_recent_data[x[0]] = x[1]
+                    cycle.append((x[0],x[1]))
+        for worker in self.workers:
+            cycle.extend(worker.read_new())
+        for uuid,value in cycle:
+            self.store_reading(uuid,value)
+        if None is not self.exporter:
+            self.exporter.add_row(time.time(),cycle)
+
+    # Samples from push plugins are stored as soon as they arrive
+    async def consume_samples(self) -> None:
+        async for sample in self.sample_receive:
+            value = sample.format()
+            self.store_reading(sample.uuid,value,sample.timestamp)
+            if None is not self.exporter:
+                self.exporter.add_row(sample.timestamp,((sample.uuid,value),))
+
+    async def supervise_workers(self) -> None:
+        for worker in self.workers:
+            worker.start()
+        while True == self.running:
+            await trio.sleep(WORKER_CHECK_SECONDS)
+            for worker in self.workers:
+                worker.check()
 
     async def collect_data(self) -> None:
         await trio.sleep(5)
-        while True == self.open:
+        # Keep collecting through D-Bus outages so nothing is lost
+        while True == self.running:
             await trio.sleep(self.update_seconds)
             await self.collect_latest()
         
+    async def save_history(self) -> None:
+        while True == self.running:
+            await trio.sleep(HISTORY_SAVE_SECONDS)
+            try:
+                await trio.to_thread.run_sync(self.history.save,self.history_file)
+            except OSError as e:
+                log.error('[save_history] ' + str(e))
+
+    # systemd stops the unit with SIGTERM. Cancelling the nursery lets
+    # listen() shut down the same way as for ^C.
+    async def watch_signals(self,nursery) -> None:
+        with trio.open_signal_receiver(signal.SIGTERM) as signals:
+            async for signum in signals:
+                log.info('Received SIGTERM, shutting down')
+                nursery.cancel_scope.cancel()
+                return
+
     async def listen(self) -> None:
         self._log_topology()
         try:
             async with trio.open_nursery() as nursery:
+                self.nursery = nursery
+                nursery.start_soon(self.watch_signals,nursery)
+                nursery.start_soon(self.loop_monitor.run)
                 nursery.start_soon(self.rx)
-                nursery.start_soon(self.register_bluez_application)
-                nursery.start_soon(self.register_bluez_agent)
-                nursery.start_soon(self.register_bluez_advertisement)
+                nursery.start_soon(self.register_with_bluez)
                 nursery.start_soon(self.collect_data)
+                if len(self.workers) > 0:
+                    nursery.start_soon(self.supervise_workers)
+                if None is not self.exporter:
+                    nursery.start_soon(self.exporter.run)
+                if None is not self.alarm_characteristic:
+                    nursery.start_soon(self.publish_alarms)
+                if None is not self.history_file:
+                    nursery.start_soon(self.save_history)
+                if len(self.push_plugins) > 0:
+                    nursery.start_soon(self.consume_samples)
+                    for name,plugin in self.push_plugins:
+                        nursery.start_soon(push_plugins.run_plugin,plugin,self.sample_send.clone(),name)
         except* KeyboardInterrupt:
+            pass
+        finally:
             await self.close()
             log.info('bye')
 
@@ -254,7 +629,8 @@ class CcsServer(dbus_objects.integration.jeepney._JeepneyServerBase):
 
     def load_plugins(self):
         self.plugins = list()
-        self.most_recent_data = dict()
+        self.workers = list()
+        self.push_plugins = list()
 
         if False == os.path.exists(SHARED_OBJECT_DIR):
             os.mkdir(SHARED_OBJECT_DIR,mode=0o755)
@@ -264,30 +640,73 @@ class CcsServer(dbus_objects.integration.jeepney._JeepneyServerBase):
                 if '__init__.py' != f:
                     f = f[:-3]
                     name = SHARED_OBJECT_DIR + '.' + f
+                    if True == self.isolate_plugins:
+                        # Imported by the worker process rather than here
+                        import plugin_worker
+                        self.workers.append(plugin_worker.PluginWorker(name,self.update_seconds))
+                        continue
                     try:
                         mod = import_module(name)
                         obj = mod.load()
+                        if True == push_plugins.is_push_plugin(obj):
+                            self.push_plugins.append((name,obj))
+                        if True == sample_pipeline.uses_pipeline(obj):
+                            self.add_to_pipeline(obj)
                         self.plugins.append(obj)
                     except Exception:
                         log.error('Failed to load plugin: ' + name)
                         pass
 
+    def allocate_storage(self):
+        if True == self.memory_budget:
+            # Everything sized up front so memory stays flat however long we run
+            import memory_budget
+            self.most_recent_data = memory_budget.CompactReadings()
+            capacity = min(self.most_recent_data.index.capacity,history.MAX_CHANNELS)
+            self.history = history.History(capacity,preallocate=True)
+        else:
+            self.most_recent_data = dict()
+            self.history = history.History()
+
+    def add_to_pipeline(self,plugin):
+        if None is self.pipeline:
+            try:
+                self.pipeline = sample_pipeline.Pipeline()
+            except RuntimeError as e:
+                log.error('Raw samples will be ignored: ' + str(e))
+                return
+        self.pipeline.add_plugin(plugin)
+
     def get_collected_data(self,uuid) -> str:
         rv = None
         if uuid in self.most_recent_data:
             rv = self.most_recent_data[uuid]
         return rv
 
+    def get_collected_bytes(self,uuid) -> bytes:
+        if True == self.memory_budget:
+            return self.most_recent_data.get_bytes(uuid)
+        rv = self.get_collected_data(uuid)
+        if None is not rv:
+            rv = rv.encode('utf-8')
+        return rv
+
 class Sensor(dbus_objects.DBusObject):
 
+    # Value chosen empirically
+    MTU = 517
+
+    # class -> GATT property table, see get_property_table
+    property_tables = dict()
+
+    # The value itself isn't kept here, the server already holds the reading
     def __init__(self,uuid,obj_name=None,server = None):
         super().__init__(name=obj_name,default_interface_root=CCS_DATA_ROOT)
-        self.value = bytes() 
         self.characteristic_name = obj_name
         self.uuid = uuid
         self.server = server
-        # Value chosen empirically
-        self.mtu = 517
+        self.notifying = False
+        self.properties = self.get_property_table()
 
     @dbus_objects.dbus_method(interface=DBUS_PROPERTIES_INTERFACE,name='Set')
     def SetProperties(self,interface_name: str,property_name: str,value: dbus_objects.types.Variant):
@@ -300,15 +719,9 @@ class Sensor(dbus_objects.DBusObject):
     @dbus_objects.dbus_method(interface=DBUS_PROPERTIES_INTERFACE,name='Get')
     def GetProperties(self,interface_name: str,property_name: str) -> dbus_objects.types.Variant:
         rv = None
-        if GATT_CHARACTERISTIC_INTERFACE == interface_name:
-            if 'UUID' == property_name:
-                rv = 's',self.get_uuid()
-            elif 'Service' == property_name:
-                rv = 'o',self.get_service_name()
-            elif 'Flags' == property_name:
-                rv = 'as',self.get_flags()
-            elif 'MTU' == property_name:
-                rv = 'q',self.get_mtu()
+        entry = self.properties.get(interface_name,{}).get(property_name)
+        if None is not entry:
+            rv = entry[0],entry[1](self)
         return rv 
 
     @dbus_objects.dbus_method(interface=DBUS_PROPERTIES_INTERFACE,name='GetAll')
@@ -329,10 +742,33 @@ class Sensor(dbus_objects.DBusObject):
 
     @dbus_objects.dbus_method(interface=GATT_CHARACTERISTIC_INTERFACE,name='ReadValue')
     def ReadValue(self,options: Dict[str,dbus_objects.types.Variant]) -> bytes:
+        return self.read_value(options)
+
+    # Only called by BlueZ for characteristics with notify or indicate flags
+    @dbus_objects.dbus_method(interface=GATT_CHARACTERISTIC_INTERFACE,name='StartNotify')
+    def StartNotify(self) -> None:
+        self.notifying = True
+
+    @dbus_objects.dbus_method(interface=GATT_CHARACTERISTIC_INTERFACE,name='StopNotify')
+    def StopNotify(self) -> None:
+        self.notifying = False
+
+    # Only called by BlueZ for characteristics with a write flag
+    @dbus_objects.dbus_method(interface=GATT_CHARACTERISTIC_INTERFACE,name='WriteValue')
+    def WriteValue(self,value: bytes,options: Dict[str,dbus_objects.types.Variant]) -> None:
+        self.write_value(value,options)
+
+    # Subclasses override this rather than WriteValue
+    def write_value(self,value,options):
+        log.debug('[Sensor:write_value] Ignoring write to ' + str(self.characteristic_name))
+
+    # Subclasses override this rather than ReadValue
+    def read_value(self,options):
         if None is not self.server:
-            self.value = self.server.get_collected_data(self.get_uuid())
-            if None is not self.value:
-                return self.value.encode('utf-8')
+            # Not kept on the sensor, the server already holds the reading
+            value = self.server.get_collected_bytes(self.get_uuid())
+            if None is not value:
+                return value
         return bytes()
 
     def hex_value_of_char(self,c):
@@ -365,25 +801,43 @@ class Sensor(dbus_objects.DBusObject):
     def get_flags(self):
         return ['read']
 
+    def can_notify(self):
+        flags = self.get_flags()
+        return 'notify' in flags or 'indicate' in flags
+
     def get_uuid(self):
         return self.uuid
 
     def get_mtu(self):
-        return self.mtu
+        return self.MTU
+
+    # interface -> property name -> (signature,getter), built once per class
+    # and shared by its instances, so a property lookup doesn't depend on how
+    # many properties there are and a characteristic doesn't carry its own
+    # copy. Getters are called with the sensor.
+    def get_property_table(self):
+        cls = type(self)
+        rv = Sensor.property_tables.get(cls)
+        if None is rv:
+            table = dict()
+            table['UUID'] = ('s',cls.get_uuid)
+            table['Service'] = ('o',cls.get_service_name)
+            table['Flags'] = ('as',cls.get_flags)
+            table['MTU'] = ('q',cls.get_mtu)
+            # Flags are fixed for each class
+            if True == self.can_notify():
+                table['Notifying'] = ('b',cls.get_notifying)
+            rv = {GATT_CHARACTERISTIC_INTERFACE: table}
+            Sensor.property_tables[cls] = rv
+        return rv
 
-    def set_value(self,new_value):
-        if isinstance(new_value,list):
-            if len(new_value) > 0:
-                if isinstance(new_value[0],int):
-                    self.value = new_value
+    def get_notifying(self):
+        return self.notifying
 
     def get_all_properties(self,interface_name):
         rv = dict()
-        if GATT_CHARACTERISTIC_INTERFACE == interface_name:
-            rv['UUID'] = ('s',self.get_uuid())
-            rv['Service'] = ('o',self.get_service_name())
-            rv['Flags'] = ('as',self.get_flags())
-            rv['MTU'] = ('q',self.get_mtu())
+        for name,(signature,getter) in self.properties.get(interface_name,{}).items():
+            rv[name] = (signature,getter(self))
         return rv 
 
     def get_path(self):
@@ -397,6 +851,81 @@ class Sensor(dbus_objects.DBusObject):
         rv[GATT_CHARACTERISTIC_INTERFACE] = self.GetAllProperties(GATT_CHARACTERISTIC_INTERFACE)
         return rv
 
+class AlarmCharacteristic(Sensor):
+
+    def __init__(self,server):
+        super().__init__(CCS_ALARM_UUID,obj_name=ALARM_LABEL,server=server)
+
+    def get_flags(self):
+        return ['read','indicate']
+
+    # Names of the alarms currently raised, separated by ';'. Long lists are
+    # read in several calls with increasing offsets.
+    def read_value(self,options):
+        rv = ';'.join(self.server.alarms.get_active()).encode('utf-8')
+        offset = options.get('offset',('q',0))[1]
+        return rv[offset:]
+
+# A client writes a JSON history query (see history.py), then reads the
+# result as a reading_codec block. BlueZ splits reads and writes longer than
+# the MTU into several ReadValue and WriteValue calls with increasing
+# offsets.
+class HistoryCharacteristic(Sensor):
+
+    def __init__(self,server):
+        super().__init__(CCS_HISTORY_UUID,obj_name=HISTORY_LABEL,server=server)
+        # Last result per connected device
+        self.results = dict()
+        # Query received so far per device, while a long write is in progress
+        self.queries = dict()
+
+    def get_flags(self):
+        return ['read','write']
+
+    # The query is a flat JSON object, so it is complete once it ends in '}'
+    def write_value(self,value,options):
+        device = options.get('device')
+        offset = options.get('offset',('q',0))[1]
+        query = self.queries.pop(device,bytes())
+        if 0 == offset:
+            query = bytes(value)
+        elif offset == len(query):
+            query += bytes(value)
+        else:
+            raise history.HistoryError('Expected a write at offset ' + str(len(query)) + ', got ' + str(offset))
+        if len(query) > HISTORY_MAX_QUERY_BYTES:
+            raise history.HistoryError('History query too long')
+        if False == query.rstrip().endswith(b'}'):
+            self.queries[device] = query
+            return
+        self.results[device] = self.server.history.query_json(query.decode('utf-8','replace'))
+
+    def read_value(self,options):
+        rv = self.results.get(options.get('device'),bytes())
+        offset = options.get('offset',('q',0))[1]
+        return rv[offset:]
+
+class LinkTestSink(Sensor):
+
+    def __init__(self,server):
+        super().__init__(CCS_LINK_SINK_UUID,obj_name=LINK_SINK_LABEL,server=server)
+
+    def get_flags(self):
+        return ['write-without-response']
+
+    def write_value(self,value,options):
+        start = self.server.link_test.handle_write(bytes(value))
+        if None is not start:
+            self.server.start_link_source(*start)
+
+class LinkTestSource(Sensor):
+
+    def __init__(self,server):
+        super().__init__(CCS_LINK_SOURCE_UUID,obj_name=LINK_SOURCE_LABEL,server=server)
+
+    def get_flags(self):
+        return ['notify']
+
 class CcsData(dbus_objects.DBusObject):
 
     def __init__(self,uuid='',is_primary=True):
@@ -405,6 +934,7 @@ class CcsData(dbus_objects.DBusObject):
         self.uuid = uuid
         self.server = None
         self.sensors = list()
+        self.properties = {GATT_SERVICE_INTERFACE: {'UUID': ('s',self.get_uuid),'Primary': ('b',self.is_primary)}}
 
     @dbus_objects.dbus_method(interface=DBUS_OBJECT_MANAGER_INTERFACE,name='GetManagedObjects')
     def GetManagedObjects(self) -> Dict[dbus_objects.types.ObjectPath,Dict[str,Dict[str,dbus_objects.types.Variant]]]:
@@ -421,11 +951,9 @@ class CcsData(dbus_objects.DBusObject):
     @dbus_objects.dbus_method(interface=DBUS_PROPERTIES_INTERFACE,name='Get')
     def GetProperties(self,interface_name: str,property_name: str) -> dbus_objects.types.Variant:
         rv = None
-        if GATT_SERVICE_INTERFACE == interface_name:
-            if 'UUID' == property_name:
-                rv = 's',self.get_uuid()
-            elif 'Primary' == property_name:
-                rv = 'b',self.is_primary()
+        entry = self.properties.get(interface_name,{}).get(property_name)
+        if None is not entry:
+            rv = entry[0],entry[1]()
         return rv 
 
     @dbus_objects.dbus_property(interface=GATT_SERVICE_INTERFACE)
@@ -444,9 +972,8 @@ class CcsData(dbus_objects.DBusObject):
 
     def get_all_properties(self,interface_name):
         rv = dict()
-        if GATT_SERVICE_INTERFACE == interface_name:
-            rv['UUID'] = ('s',self.get_uuid())
-            rv['Primary'] = ('b',self.is_primary())
+        for name,(signature,getter) in self.properties.get(interface_name,{}).items():
+            rv[name] = (signature,getter())
         return rv 
 
     def add_sensor(self,v):
@@ -464,6 +991,66 @@ class CcsData(dbus_objects.DBusObject):
             rv[sensor.get_path()] = sensor.get_all_interfaces()
         return rv
 
+class Diagnostics(dbus_objects.DBusObject):
+
+    def __init__(self,server):
+        super().__init__(default_interface_root=CCS_ROOT)
+        self.server = server
+
+    @dbus_objects.dbus_method(interface=CCS_NAME,name='GetMemoryUsage')
+    def GetMemoryUsage(self) -> Dict[str,dbus_objects.types.UInt64]:
+        import memory_budget
+        rv = memory_budget.get_memory_usage()
+        rv['channels'] = len(self.server.most_recent_data)
+        rv['outage_readings'] = self.server.outage_readings
+        return rv
+
+    # Tracing slows every allocation, so it only runs between these two
+    @dbus_objects.dbus_method(interface=CCS_NAME,name='StartHeapTrace')
+    def StartHeapTrace(self) -> None:
+        import memory_budget
+        memory_budget.start_tracing()
+
+    @dbus_objects.dbus_method(interface=CCS_NAME,name='StopHeapTrace')
+    def StopHeapTrace(self) -> None:
+        import memory_budget
+        memory_budget.stop_tracing()
+
+    @dbus_objects.dbus_method(interface=CCS_NAME,name='GetTopAllocations')
+    def GetTopAllocations(self) -> List[str]:
+        import memory_budget
+        return memory_budget.get_top_allocations()
+
+    @dbus_objects.dbus_method(interface=CCS_NAME,name='GetAlarmHistory')
+    def GetAlarmHistory(self) -> List[str]:
+        if None is self.server.alarms:
+            return list()
+        return [str(x) for x in self.server.alarms.history]
+
+    # Same query and result as the history characteristic
+    @dbus_objects.dbus_method(interface=CCS_NAME,name='GetHistory')
+    def GetHistory(self,uuid: str,start: float,end: float,points: int) -> bytes:
+        return self.server.history.query(uuid,start,end,points)
+
+    @dbus_objects.dbus_method(interface=CCS_NAME,name='GetLinkTest')
+    def GetLinkTest(self) -> Dict[str,float]:
+        if None is self.server.link_test:
+            return dict()
+        return self.server.link_test.get_results()
+
+    # Returns the path the collapsed stacks will be written to
+    @dbus_objects.dbus_method(interface=CCS_NAME,name='StartProfile')
+    def StartProfile(self,seconds: int) -> str:
+        return self.server.start_profile(seconds)
+
+    @dbus_objects.dbus_method(interface=CCS_NAME,name='GetLoopLag')
+    def GetLoopLag(self) -> Dict[str,float]:
+        return self.server.loop_monitor.get_stats()
+
+    @dbus_objects.dbus_method(interface=CCS_NAME,name='GetLoopStalls')
+    def GetLoopStalls(self) -> List[str]:
+        return self.server.loop_monitor.get_episodes()
+
 class Advertisement(dbus_objects.DBusObject):
 
     def __init__(self):
@@ -664,6 +1251,7 @@ class Advertisement(dbus_objects.DBusObject):
     #    return rv
 
     def get_local_name(self):
+        import platform
         return platform.node()
 
     #def get_appearance(self):
@@ -765,6 +1353,7 @@ class Agent(dbus_objects.DBusObject):
     
 
 def get_adapter_names_from_xml(xml):
+    import xml.etree.ElementTree as et
     rv = list()
     root = et.fromstring(xml)
     for child in root:
@@ -828,13 +1417,39 @@ async def setup_adapter(interface):
 
 
 async def app():
+    # Only needed once, so keep it off the import path
+    import argparse
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('-i','--interface',help='Bluetooth interface name (i.e. hci0)')
+    arg_parser.add_argument('--isolate-plugins',action='store_true',help='Run each plugin in its own supervised process')
+    arg_parser.add_argument('--memory-budget',action='store_true',help='Use fixed-size storage for readings')
+    arg_parser.add_argument('--uplink-url',help='Also upload readings in batches to this HTTP endpoint')
+    arg_parser.add_argument('--uplink-dir',default='uplink_spool',help='Where batches wait to be uploaded (default: uplink_spool)')
+    arg_parser.add_argument('--alarm-rules',help='JSON file of alarm rules, enables the alarm characteristic')
+    arg_parser.add_argument('--history-file',help='Keep the downsampled reading history in this file across restarts')
+    arg_parser.add_argument('--link-test',action='store_true',help='Add the BLE throughput test characteristics')
+    arg_parser.add_argument('--profile-startup',action='store_true',help='Report import times and startup milestones once advertising')
     args = arg_parser.parse_args()
 
+    if None is not startup_profile:
+        startup_profile.milestone('imports done')
+
     await setup_adapter(args.interface)
 
-    server = await CcsServer.new(bus='SYSTEM',name=CCS_NAME)
+    if None is not startup_profile:
+        startup_profile.milestone('adapter ready')
+
+    server = await CcsServer.new(bus='SYSTEM',name=CCS_NAME,isolate_plugins=args.isolate_plugins,memory_budget=args.memory_budget)
+    server.interface = args.interface
+
+    if None is not startup_profile:
+        startup_profile.milestone('D-Bus connected, plugins loaded')
+
+    if None is not args.uplink_url:
+        import uplink
+        server.exporter = uplink.UplinkExporter(args.uplink_url,spool_dir=args.uplink_dir)
+
+    server.register_object(CCS_ROOT,Diagnostics(server))
 
     data_object = CcsData(uuid=CCS_DATA_SERVICE_UUID,is_primary=True)
     # Register the CcsData object with DBUS
@@ -852,6 +1467,31 @@ async def app():
     data_object.add_sensor(pressure_sensor)
     server.register_object(CCS_DATA_ROOT + '/' + PRESSURE_LABEL,pressure_sensor)
 
+    if None is not args.alarm_rules:
+        import alarms
+        server.alarms = alarms.AlarmEngine()
+        server.alarms.load_rules(args.alarm_rules)
+        server.alarm_characteristic = AlarmCharacteristic(server)
+        data_object.add_sensor(server.alarm_characteristic)
+        server.register_object(CCS_DATA_ROOT + '/' + ALARM_LABEL,server.alarm_characteristic)
+
+    if None is not args.history_file:
+        server.history_file = args.history_file
+        server.history.load(args.history_file)
+    history_characteristic = HistoryCharacteristic(server)
+    data_object.add_sensor(history_characteristic)
+    server.register_object(CCS_DATA_ROOT + '/' + HISTORY_LABEL,history_characteristic)
+
+    if True == args.link_test:
+        import link_test
+        server.link_test = link_test.LinkTest()
+        link_sink = LinkTestSink(server)
+        data_object.add_sensor(link_sink)
+        server.register_object(CCS_DATA_ROOT + '/' + LINK_SINK_LABEL,link_sink)
+        server.link_source = LinkTestSource(server)
+        data_object.add_sensor(server.link_source)
+        server.register_object(CCS_DATA_ROOT + '/' + LINK_SOURCE_LABEL,server.link_source)
+
 
     await server.listen()    
 
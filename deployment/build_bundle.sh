@@ -1,6 +1,9 @@
 VERSION="NotForRelease"
 SUFFIX="WeatherStation_Install_Bundle"
 DBUS_OBJS_PATH="../ccs_dbus_objects"
+# Bytecode is specific to the Python version, so this has to match the
+# interpreter on the target device (Raspberry Pi OS Bookworm ships 3.11)
+TARGET_PYTHON="${TARGET_PYTHON:-python3.11}"
 
 if [ $# -eq 1 ]; then
     VERSION="$1"
@@ -13,9 +16,19 @@ if [ ! -d "${DBUS_OBJS_PATH}" ]; then
     exit
 fi
 
-zip -r "${VERSION}_${SUFFIX}.zip" ./manifest.xml ../data_server.py ../bluez_dbus.py ../requirements.txt ../plugins/*.py ../system/ccsdata.service ../system/com.clearcreeksci.conf ../ccs_dbus_objects
-
-
+if ! command -v "${TARGET_PYTHON}" > /dev/null; then
+    echo "Couldn't find ${TARGET_PYTHON} to precompile the bundle. Set TARGET_PYTHON. BAILING OUT..."
+    exit
+fi
 
+SOURCES="../data_server.py ../bluez_dbus.py ../plugin_worker.py ../sample_pipeline.py ../reading_codec.py ../startup_profile.py ../memory_budget.py ../loop_monitor.py ../uplink.py ../push_plugins.py ../alarms.py ../history.py ../link_test.py ../sampling_profiler.py"
 
+# Ship precompiled bytecode so the first start on the device doesn't pay to
+# compile everything. checked-hash pycs are compared against a hash of the
+# source rather than its timestamp, so they survive unzipping, and a plugin
+# or module edited on the device is recompiled instead of silently ignored.
+rm -rf ../__pycache__ ../plugins/__pycache__
+find ${DBUS_OBJS_PATH} -name __pycache__ -prune -exec rm -rf {} \;
+"${TARGET_PYTHON}" -m compileall -q -j 0 --invalidation-mode checked-hash ${SOURCES} ../plugins ${DBUS_OBJS_PATH}
 
+zip -r "${VERSION}_${SUFFIX}.zip" ./manifest.xml ${SOURCES} ../__pycache__ ../requirements.txt ../plugins/*.py ../plugins/__pycache__ ../system/ccsdata.service ../system/com.clearcreeksci.conf ${DBUS_OBJS_PATH}
@@ -0,0 +1,339 @@
+"""
+    history.py
+    Downsampled reading history for charting
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    Every numeric reading is folded into rollup tiers as it arrives. A tier
+    is a ring of fixed-width time buckets per channel, each holding the min,
+    max, sum and count of the readings that fell into it:
+
+        width       buckets     covers
+        1 minute    1440        1 day
+        15 minutes  2976        31 days
+        1 hour      8784        366 days
+
+    Adding a reading touches one bucket per tier, and memory per channel is
+    fixed (about 370 KB) however long the station runs. At most max_channels
+    channels are kept (MAX_CHANNELS by default), and with preallocate they
+    are all allocated up front so memory use doesn't change as channels
+    appear.
+
+    query() answers "uuid from start to end in at most points points" from
+    the finest tier that covers start and needs no more than points buckets
+    for the range, falling back to the coarsest tier with neighbouring
+    buckets merged until they fit. The result is a
+    reading_codec block with min, mean and max columns, one row per bucket
+    that has readings, timestamped at the start of the bucket. A 30 day
+    chart of 500 points is a couple of kilobytes.
+
+    Clients send a query as JSON, e.g.
+
+        {"uuid": "a0ce0210-...", "start": 1760000000, "end": 1762592000,
+         "points": 500}
+
+    start and end are seconds as from time.time(). end defaults to now,
+    start to a day before end and points to DEFAULT_POINTS.
+
+    save() and load() keep the tiers in a file laid out as:
+
+        'CCSH'                      magic
+        u8                          version (1)
+        u8                          byte order of the arrays, 0 little, 1 big
+        u8                          tier count
+        u16                         channel count
+        u32, u32                    width and size of each tier
+        for each channel:
+            u8 + bytes              uuid (utf-8)
+            u8                      digits
+            for each tier:
+                i64                 newest bucket
+                arrays              buckets, mins, maxs, sums, counts as
+                                    stored in memory
+
+    Header fields are little endian. The arrays are written as they are in
+    memory, since the file never leaves the station.
+"""
+
+import os
+import sys
+import time
+import struct
+import logging
+
+from array import array
+
+import reading_codec
+
+# (bucket seconds,bucket count)
+TIERS                               = ((60,1440),(900,2976),(3600,8784))
+DEFAULT_POINTS                      = 500
+MAX_POINTS                          = 2000
+DEFAULT_RANGE_SECONDS               = 86400
+MAX_CHANNELS                        = 16
+FILE_MAGIC                          = b'CCSH'
+FILE_VERSION                        = 1
+FILE_HEADER_FORMAT                  = '<4sBBBH'
+FILE_TIER_FORMAT                    = '<II'
+FILE_NEWEST_FORMAT                  = '<q'
+BYTE_ORDER                          = 0 if 'little' == sys.byteorder else 1
+
+log = logging.getLogger(__name__)
+
+
+class HistoryError(Exception):
+    pass
+
+
+class Tier(object):
+
+    def __init__(self,width,size):
+        self.width = width
+        self.size = size
+        # Bucket number held in each slot, -1 if empty
+        self.buckets = array('q',[-1]) * size
+        self.mins = array('f',[0.0]) * size
+        self.maxs = array('f',[0.0]) * size
+        self.sums = array('d',[0.0]) * size
+        self.counts = array('I',[0]) * size
+        self.newest = -1
+
+    def add(self,timestamp,value):
+        bucket = int(timestamp // self.width)
+        # Too old for the ring
+        if bucket <= self.newest - self.size:
+            return
+        slot = bucket % self.size
+        if bucket != self.buckets[slot]:
+            self.buckets[slot] = bucket
+            self.mins[slot] = value
+            self.maxs[slot] = value
+            self.sums[slot] = value
+            self.counts[slot] = 1
+        else:
+            if value < self.mins[slot]:
+                self.mins[slot] = value
+            if value > self.maxs[slot]:
+                self.maxs[slot] = value
+            self.sums[slot] += value
+            self.counts[slot] += 1
+        if bucket > self.newest:
+            self.newest = bucket
+
+    # True if the ring still holds buckets back to timestamp
+    def covers(self,timestamp):
+        return int(timestamp // self.width) > self.newest - self.size
+
+    def bucket_count(self,start,end):
+        return int(end // self.width) - int(start // self.width) + 1
+
+    # Returns (timestamps,mins,sums,maxs,counts) for buckets with readings
+    def read(self,start,end):
+        timestamps = list()
+        mins = list()
+        sums = list()
+        maxs = list()
+        counts = list()
+        first = max(int(start // self.width),self.newest - self.size + 1)
+        last = min(int(end // self.width),self.newest)
+        for bucket in range(first,last + 1):
+            slot = bucket % self.size
+            if bucket != self.buckets[slot]:
+                continue
+            timestamps.append(bucket * self.width)
+            mins.append(self.mins[slot])
+            sums.append(self.sums[slot])
+            maxs.append(self.maxs[slot])
+            counts.append(self.counts[slot])
+        return timestamps,mins,sums,maxs,counts
+
+    def clear(self):
+        for i in range(self.size):
+            self.buckets[i] = -1
+        self.newest = -1
+
+    def arrays(self):
+        return (self.buckets,self.mins,self.maxs,self.sums,self.counts)
+
+    def write_to(self,f):
+        f.write(struct.pack(FILE_NEWEST_FORMAT,self.newest))
+        for a in self.arrays():
+            a.tofile(f)
+
+    # Reads straight into the existing arrays
+    def read_from(self,f):
+        b = f.read(struct.calcsize(FILE_NEWEST_FORMAT))
+        if len(b) != struct.calcsize(FILE_NEWEST_FORMAT):
+            raise HistoryError('Truncated tier')
+        self.newest, = struct.unpack(FILE_NEWEST_FORMAT,b)
+        for a in self.arrays():
+            view = memoryview(a).cast('B')
+            if f.readinto(view) != len(view):
+                raise HistoryError('Truncated tier')
+
+
+class Channel(object):
+
+    def __init__(self,digits=0):
+        self.digits = digits
+        self.tiers = [Tier(width,size) for width,size in TIERS]
+
+
+class History(object):
+
+    def __init__(self,max_channels=MAX_CHANNELS,preallocate=False):
+        self.max_channels = max_channels
+        self.channels = dict()
+        # Channels allocated up front and not yet in use
+        self.spare = list()
+        if True == preallocate:
+            self.spare = [Channel() for i in range(max_channels)]
+        self.full_logged = False
+
+    # Returns None once max_channels are in use
+    def new_channel(self,uuid,digits):
+        if len(self.channels) >= self.max_channels:
+            if False == self.full_logged:
+                log.warning('[History:new_channel] History is full at %d channels, not keeping %s',self.max_channels,uuid)
+                self.full_logged = True
+            return None
+        if len(self.spare) > 0:
+            rv = self.spare.pop()
+            rv.digits = digits
+        else:
+            rv = Channel(digits)
+        self.channels[uuid] = rv
+        return rv
+
+    # value is a reading as stored by the server, non-numeric ones are ignored
+    def add(self,uuid,value,timestamp):
+        parsed = reading_codec.parse_reading(value)
+        if None is parsed:
+            return
+        v,digits = parsed
+        channel = self.channels.get(uuid)
+        if None is channel:
+            channel = self.new_channel(uuid,digits)
+            if None is channel:
+                return
+        elif digits > channel.digits:
+            channel.digits = digits
+        for tier in channel.tiers:
+            tier.add(timestamp,v)
+
+    def choose_tier(self,channel,start,end,points):
+        for tier in channel.tiers:
+            if True == tier.covers(start) and tier.bucket_count(start,end) <= points:
+                return tier
+        return channel.tiers[-1]
+
+    # Returns a reading_codec block, see the module docstring
+    def query(self,uuid,start=None,end=None,points=DEFAULT_POINTS):
+        channel = self.channels.get(uuid)
+        if None is channel:
+            raise HistoryError('No history for ' + str(uuid))
+        if None is end:
+            end = time.time()
+        if None is start:
+            start = end - DEFAULT_RANGE_SECONDS
+        if start > end:
+            raise HistoryError('start is after end')
+        points = max(1,min(int(points),MAX_POINTS))
+        tier = self.choose_tier(channel,start,end,points)
+        timestamps,mins,sums,maxs,counts = tier.read(start,end)
+        # Only the coarsest tier can return more than asked for
+        step = -(-len(timestamps) // points)
+        if step > 1:
+            timestamps = timestamps[::step]
+            mins = [min(mins[i:i + step]) for i in range(0,len(mins),step)]
+            maxs = [max(maxs[i:i + step]) for i in range(0,len(maxs),step)]
+            sums = [sum(sums[i:i + step]) for i in range(0,len(sums),step)]
+            counts = [sum(counts[i:i + step]) for i in range(0,len(counts),step)]
+        means = [x / n for x,n in zip(sums,counts)]
+        columns = {'min': mins,'mean': means,'max': maxs}
+        digits = dict.fromkeys(columns,channel.digits)
+        return reading_codec.encode_block(timestamps,columns,digits)
+
+    def query_json(self,request):
+        # Only needed once a client asks
+        import json
+        try:
+            x = json.loads(request)
+            return self.query(x['uuid'],x.get('start'),x.get('end'),x.get('points',DEFAULT_POINTS))
+        except (ValueError,TypeError,KeyError) as e:
+            raise HistoryError('Bad history query: ' + str(e))
+
+    # Blocking, run in a thread. See the module docstring for the layout.
+    def save(self,path):
+        channels = list(self.channels.items())
+        tmp = path + '.tmp'
+        with open(tmp,'wb') as f:
+            f.write(struct.pack(FILE_HEADER_FORMAT,FILE_MAGIC,FILE_VERSION,BYTE_ORDER,len(TIERS),len(channels)))
+            for width,size in TIERS:
+                f.write(struct.pack(FILE_TIER_FORMAT,width,size))
+            for uuid,channel in channels:
+                name = uuid.encode('utf-8')
+                f.write(struct.pack('<B',len(name)) + name + struct.pack('<B',channel.digits))
+                for tier in channel.tiers:
+                    tier.write_to(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp,path)
+
+    # Called at startup, before any readings arrive
+    def load(self,path):
+        try:
+            with open(path,'rb') as f:
+                self.read_channels(f)
+        except FileNotFoundError:
+            return
+        except (OSError,HistoryError,struct.error,UnicodeDecodeError) as e:
+            log.warning('[History:load] Ignoring ' + path + ': ' + str(e))
+            for channel in self.channels.values():
+                for tier in channel.tiers:
+                    tier.clear()
+                self.spare.append(channel)
+            self.channels = dict()
+            return
+        log.info('Loaded history for ' + str(len(self.channels)) + ' channels from ' + path)
+
+    def read_channels(self,f):
+        b = f.read(struct.calcsize(FILE_HEADER_FORMAT))
+        if len(b) != struct.calcsize(FILE_HEADER_FORMAT):
+            raise HistoryError('Not a history file')
+        magic,version,byte_order,ntiers,nchannels = struct.unpack(FILE_HEADER_FORMAT,b)
+        if FILE_MAGIC != magic:
+            raise HistoryError('Not a history file')
+        if FILE_VERSION != version:
+            raise HistoryError('Unsupported version ' + str(version))
+        if BYTE_ORDER != byte_order:
+            raise HistoryError('Written on a machine with a different byte order')
+        tiers = list()
+        for i in range(ntiers):
+            tiers.append(struct.unpack(FILE_TIER_FORMAT,f.read(struct.calcsize(FILE_TIER_FORMAT))))
+        if [tuple(x) for x in TIERS] != tiers:
+            raise HistoryError('Tier layout changed')
+        for i in range(nchannels):
+            n, = struct.unpack('<B',f.read(1))
+            uuid = f.read(n).decode('utf-8')
+            digits, = struct.unpack('<B',f.read(1))
+            channel = self.new_channel(uuid,digits)
+            if None is channel:
+                # Room for no more, skip the rest
+                break
+            for tier in channel.tiers:
+                tier.read_from(f)
@@ -0,0 +1,146 @@
+"""
+    link_test.py
+    Measures BLE link throughput and latency for the connected client
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    Backs a pair of diagnostic characteristics: a write-without-response sink
+    and a notify source. Every write to the sink starts with an opcode byte,
+    multi-byte fields are little endian:
+
+        0x00 RESET                    clear all results
+        0x01 DATA   <anything>        counted towards upload throughput
+        0x02 ECHO   u32 seq           a source packet sent back by the client,
+                                      used for round-trip time
+        0x03 START  u16 size,         have the source notify count packets of
+                    u16 count,        size bytes, interval_ms apart
+                    u16 interval_ms
+        0x04 REPORT u32 bytes,        the client's own count of source bytes
+                    u32 elapsed_ms    received, for download throughput
+
+    Source packets are 0x10, u32 seq, then padding up to the requested size.
+    A client measures the link by subscribing to the source, writing START,
+    echoing some packets back and finally writing REPORT. Upload throughput
+    comes from a stream of DATA writes.
+"""
+
+import time
+import struct
+import logging
+
+OP_RESET                            = 0x00
+OP_DATA                             = 0x01
+OP_ECHO                             = 0x02
+OP_START                            = 0x03
+OP_REPORT                           = 0x04
+OP_SOURCE                           = 0x10
+
+# ATT notifications carry at most MTU - 3 bytes
+MAX_PAYLOAD                         = 514
+MIN_PAYLOAD                         = 5
+MAX_TRACKED_PACKETS                 = 1024
+
+log = logging.getLogger(__name__)
+
+
+class LinkTest(object):
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.rx_bytes = 0
+        self.rx_writes = 0
+        self.rx_first = None
+        self.rx_last = None
+        self.tx_bytes = 0
+        self.tx_packets = 0
+        self.tx_first = None
+        self.tx_last = None
+        self.sent = dict()
+        self.rtts = list()
+        self.client_bytes = 0
+        self.client_seconds = 0.0
+
+    # Returns (size,count,interval_seconds) for a START, otherwise None
+    def handle_write(self,value):
+        rv = None
+        if 0 == len(value):
+            return rv
+        now = time.monotonic()
+        op = value[0]
+        if OP_RESET == op:
+            self.reset()
+        elif OP_DATA == op:
+            if None is self.rx_first:
+                self.rx_first = now
+            self.rx_last = now
+            self.rx_bytes += len(value)
+            self.rx_writes += 1
+        elif OP_ECHO == op and len(value) >= 5:
+            seq, = struct.unpack_from('<I',value,1)
+            sent = self.sent.pop(seq,None)
+            if None is not sent and len(self.rtts) < MAX_TRACKED_PACKETS:
+                self.rtts.append(now - sent)
+        elif OP_START == op and len(value) >= 7:
+            size,count,interval = struct.unpack_from('<HHH',value,1)
+            size = max(MIN_PAYLOAD,min(size,MAX_PAYLOAD))
+            # Sequence numbers start again with the new run
+            self.sent.clear()
+            rv = size,count,interval / 1000
+        elif OP_REPORT == op and len(value) >= 9:
+            self.client_bytes,elapsed = struct.unpack_from('<II',value,1)
+            self.client_seconds = elapsed / 1000
+            log.info('Link test: ' + str(self.get_results()))
+        return rv
+
+    def make_packet(self,seq,size):
+        return struct.pack('<BI',OP_SOURCE,seq) + bytes(size - MIN_PAYLOAD)
+
+    def note_sent(self,seq,size):
+        now = time.monotonic()
+        if None is self.tx_first:
+            self.tx_first = now
+        self.tx_last = now
+        self.tx_bytes += size
+        self.tx_packets += 1
+        if len(self.sent) < MAX_TRACKED_PACKETS:
+            self.sent[seq] = now
+
+    def get_results(self):
+        rv = dict()
+        rx_seconds = 0.0
+        if None is not self.rx_first:
+            rx_seconds = self.rx_last - self.rx_first
+        tx_seconds = 0.0
+        if None is not self.tx_first:
+            tx_seconds = self.tx_last - self.tx_first
+        rv['rx_bytes'] = float(self.rx_bytes)
+        rv['rx_writes'] = float(self.rx_writes)
+        rv['rx_bytes_per_second'] = self.rx_bytes / rx_seconds if rx_seconds > 0 else 0.0
+        rv['tx_bytes'] = float(self.tx_bytes)
+        rv['tx_packets'] = float(self.tx_packets)
+        # How fast BlueZ accepted notifications, an upper bound on the link
+        rv['tx_bytes_per_second'] = self.tx_bytes / tx_seconds if tx_seconds > 0 else 0.0
+        rv['client_bytes'] = float(self.client_bytes)
+        rv['client_bytes_per_second'] = self.client_bytes / self.client_seconds if self.client_seconds > 0 else 0.0
+        rv['rtt_samples'] = float(len(self.rtts))
+        if len(self.rtts) > 0:
+            rv['rtt_min_ms'] = min(self.rtts) * 1000
+            rv['rtt_avg_ms'] = (sum(self.rtts) / len(self.rtts)) * 1000
+            rv['rtt_max_ms'] = max(self.rtts) * 1000
+        return rv
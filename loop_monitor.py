@@ -0,0 +1,171 @@
+"""
+    loop_monitor.py
+    Watches the trio event loop for stalls and pets the systemd watchdog
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    The monitor task sleeps for a fixed interval and measures how late it
+    wakes up. That lateness is time the loop spent on something else without
+    yielding, i.e. a blocking call somewhere. An instrument times every task
+    step so a late wakeup can be blamed on the task that held the loop
+    longest.
+
+    When systemd starts us with WatchdogSec set, the monitor sends
+    WATCHDOG=1 at half the watchdog interval, but only while the worst lag
+    since the last ping is under LAG_LIMIT_SECONDS. A wedged loop can't ping
+    at all, and one that keeps stalling stops pinging, so either way systemd
+    restarts the service.
+"""
+
+import os
+import time
+import array
+import socket
+import logging
+import trio
+
+from collections import deque
+
+SAMPLE_SECONDS                      = 0.1
+HISTORY_SAMPLES                     = 600
+STALL_SECONDS                       = 0.25
+LAG_LIMIT_SECONDS                   = 2.0
+EPISODE_HISTORY                     = 32
+
+log = logging.getLogger(__name__)
+
+
+class TaskStepInstrument(trio.abc.Instrument):
+
+    def __init__(self):
+        self.current = None
+        self.step_start = 0.0
+        self.worst_seconds = 0.0
+        self.worst_task = None
+
+    def before_task_step(self,task):
+        self.current = task
+        self.step_start = time.perf_counter()
+
+    def after_task_step(self,task):
+        elapsed = time.perf_counter() - self.step_start
+        self.current = None
+        if elapsed > self.worst_seconds:
+            self.worst_seconds = elapsed
+            self.worst_task = task.name
+
+    # Returns and resets the longest step seen since the last call
+    def take_worst(self):
+        rv = self.worst_seconds,self.worst_task
+        self.worst_seconds = 0.0
+        self.worst_task = None
+        return rv
+
+
+# Minimal sd_notify(3), without depending on libsystemd
+def sd_notify(state):
+    address = os.environ.get('NOTIFY_SOCKET')
+    if None is address:
+        return False
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM) as sock:
+            sock.sendto(state.encode('utf-8'),address)
+    except OSError as e:
+        log.error('[sd_notify] ' + str(e))
+        return False
+    return True
+
+# Seconds between watchdog pings systemd expects, or None if it isn't watching
+def get_watchdog_seconds():
+    rv = None
+    usec = os.environ.get('WATCHDOG_USEC')
+    pid = os.environ.get('WATCHDOG_PID')
+    if None is not usec and (None is pid or str(os.getpid()) == pid):
+        try:
+            rv = int(usec) / 1000000
+        except ValueError:
+            pass
+    return rv
+
+
+class LoopMonitor(object):
+
+    def __init__(self):
+        self.instrument = TaskStepInstrument()
+        self.lags = array.array('d',bytes(8 * HISTORY_SAMPLES))
+        self.count = 0
+        self.episodes = deque(maxlen=EPISODE_HISTORY)
+        self.watchdog_seconds = get_watchdog_seconds()
+        self.worst_since_ping = 0.0
+        self.pings = 0
+        self.missed_pings = 0
+
+    def record(self,lag):
+        self.lags[self.count % HISTORY_SAMPLES] = lag
+        self.count += 1
+        if lag > self.worst_since_ping:
+            self.worst_since_ping = lag
+        worst,task = self.instrument.take_worst()
+        if lag > STALL_SECONDS:
+            self.episodes.append((time.time(),lag,task,worst))
+            log.warning('Event loop stalled for %.3f seconds, longest step was %.3f seconds in task %s',lag,worst,task)
+
+    def get_stats(self):
+        rv = dict()
+        n = min(self.count,HISTORY_SAMPLES)
+        samples = sorted(self.lags[:n])
+        for name,p in (('p50',0.5),('p90',0.9),('p99',0.99)):
+            rv[name] = samples[int(p * (n - 1))] if n > 0 else 0.0
+        rv['max'] = samples[-1] if n > 0 else 0.0
+        rv['stalls'] = float(len(self.episodes))
+        rv['watchdog_pings'] = float(self.pings)
+        rv['watchdog_missed'] = float(self.missed_pings)
+        return rv
+
+    def get_episodes(self):
+        rv = list()
+        for t,lag,task,worst in self.episodes:
+            rv.append('%s lag %.3fs, longest step %.3fs in %s' % (time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(t)),lag,worst,task))
+        return rv
+
+    def pet_watchdog(self):
+        if self.worst_since_ping < LAG_LIMIT_SECONDS:
+            if True == sd_notify('WATCHDOG=1'):
+                self.pings += 1
+        else:
+            self.missed_pings += 1
+            log.error('Not petting the watchdog, loop lag reached %.3f seconds',self.worst_since_ping)
+        self.worst_since_ping = 0.0
+
+    async def run(self):
+        trio.lowlevel.add_instrument(self.instrument)
+        if None is not self.watchdog_seconds:
+            log.info('systemd watchdog every %.1f seconds' % self.watchdog_seconds)
+        next_ping = trio.current_time()
+        try:
+            while True:
+                start = trio.current_time()
+                await trio.sleep(SAMPLE_SECONDS)
+                now = trio.current_time()
+                self.record(max(0.0,now - start - SAMPLE_SECONDS))
+                if None is not self.watchdog_seconds and now >= next_ping:
+                    self.pet_watchdog()
+                    next_ping = now + (self.watchdog_seconds / 2)
+        finally:
+            trio.lowlevel.remove_instrument(self.instrument)
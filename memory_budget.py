@@ -0,0 +1,158 @@
+"""
+    memory_budget.py
+    Fixed-size storage for readings and heap usage reporting
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    Used by the server's memory budget mode. Everything here is allocated up
+    front with a fixed capacity, so the memory used for readings doesn't grow
+    with uptime or churn the allocator. Values are kept utf-8 encoded in
+    fixed-width slots of a single bytearray, which is also the form BlueZ
+    wants them in.
+"""
+
+import os
+import array
+import logging
+import tracemalloc
+
+DEFAULT_MAX_CHANNELS                = 64
+DEFAULT_VALUE_WIDTH                 = 32
+
+log = logging.getLogger(__name__)
+
+
+class ChannelIndex(object):
+
+    __slots__ = ('slots','names','capacity')
+
+    def __init__(self,capacity):
+        self.capacity = capacity
+        self.slots = dict()
+        self.names = [None] * capacity
+
+    # Returns the slot for uuid, allocating one if there is room, else None
+    def lookup(self,uuid,create=False):
+        rv = self.slots.get(uuid)
+        if None is rv and True == create:
+            if len(self.slots) < self.capacity:
+                rv = len(self.slots)
+                self.slots[uuid] = rv
+                self.names[rv] = uuid
+            else:
+                log.error('[ChannelIndex:lookup] No room for channel ' + str(uuid))
+        return rv
+
+    def __len__(self):
+        return len(self.slots)
+
+
+# Stands in for the server's most_recent_data dict
+class CompactReadings(object):
+
+    __slots__ = ('index','width','data','lengths')
+
+    def __init__(self,max_channels=DEFAULT_MAX_CHANNELS,value_width=DEFAULT_VALUE_WIDTH):
+        self.index = ChannelIndex(max_channels)
+        self.width = value_width
+        self.data = bytearray(max_channels * value_width)
+        self.lengths = array.array('B',bytes(max_channels))
+
+    def __contains__(self,uuid):
+        slot = self.index.lookup(uuid)
+        return None is not slot and self.lengths[slot] > 0
+
+    def __setitem__(self,uuid,value):
+        slot = self.index.lookup(uuid,True)
+        if None is slot:
+            return
+        b = value.encode('utf-8')[:self.width]
+        start = slot * self.width
+        self.data[start:start + len(b)] = b
+        self.lengths[slot] = len(b)
+
+    def get_bytes(self,uuid):
+        rv = None
+        slot = self.index.lookup(uuid)
+        if None is not slot and self.lengths[slot] > 0:
+            start = slot * self.width
+            rv = bytes(self.data[start:start + self.lengths[slot]])
+        return rv
+
+    def __getitem__(self,uuid):
+        rv = self.get_bytes(uuid)
+        if None is rv:
+            raise KeyError(uuid)
+        return rv.decode('utf-8','ignore')
+
+    def get(self,uuid,default=None):
+        rv = self.get_bytes(uuid)
+        if None is rv:
+            return default
+        return rv.decode('utf-8','ignore')
+
+    def items(self):
+        for uuid,slot in self.index.slots.items():
+            if self.lengths[slot] > 0:
+                yield uuid,self[uuid]
+
+    def __len__(self):
+        return len(self.index)
+
+
+# Tracing adds a record to every live allocation, so it is only switched on
+# while someone is looking
+def start_tracing():
+    if False == tracemalloc.is_tracing():
+        # One frame per allocation keeps the tracing overhead down
+        tracemalloc.start(1)
+        log.info('Heap tracing started')
+
+def stop_tracing():
+    if True == tracemalloc.is_tracing():
+        tracemalloc.stop()
+        log.info('Heap tracing stopped')
+
+def get_rss():
+    rv = 0
+    try:
+        with open('/proc/self/statm') as f:
+            rv = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError,ValueError,IndexError):
+        pass
+    return rv
+
+# Sizes in bytes. The heap figures are only available while tracing.
+def get_memory_usage():
+    rv = dict()
+    current = 0
+    peak = 0
+    if True == tracemalloc.is_tracing():
+        current,peak = tracemalloc.get_traced_memory()
+    rv['heap_current'] = current
+    rv['heap_peak'] = peak
+    rv['rss'] = get_rss()
+    return rv
+
+# The lines of code holding the most memory, for tracking down growth
+def get_top_allocations(count=10):
+    rv = list()
+    if True == tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        for stat in snapshot.statistics('lineno')[:count]:
+            rv.append(str(stat))
+    return rv
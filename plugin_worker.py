@@ -0,0 +1,274 @@
+"""
+    plugin_worker.py
+    Runs a data station plugin in its own process
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    Each worker process imports one plugin, polls it and writes its readings
+    into a shared memory ring. The server reads the ring in place, so nothing
+    is pickled or sent through a pipe, and a plugin that crashes, leaks or
+    spins only takes its own process down.
+
+    Ring layout (little endian):
+
+        header : u64 number of readings written so far
+        slot[n]: u64 sequence, 36 byte uuid, u16 value length, 64 byte value
+
+    A slot's sequence is odd while the writer is filling it in and
+    2 * (reading number + 1) once it is complete, so the reader can tell a
+    finished slot from one that is being overwritten.
+
+    Workers are started as "python -m plugin_worker MODULE RING SLOTS
+    SECONDS" so that they only import this module and the plugin, not the
+    server and everything it depends on.
+"""
+
+import os
+import sys
+import time
+import struct
+import logging
+import threading
+import subprocess
+import trio
+
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+from importlib import import_module
+
+import push_plugins
+import sample_pipeline
+
+HEADER_FORMAT                       = '<Q'
+HEADER_SIZE                         = struct.calcsize(HEADER_FORMAT)
+SEQ_FORMAT                          = '<Q'
+SEQ_SIZE                            = struct.calcsize(SEQ_FORMAT)
+BODY_FORMAT                         = '<36sH64s'
+SLOT_SIZE                           = SEQ_SIZE + struct.calcsize(BODY_FORMAT)
+MAX_UUID_BYTES                      = 36
+MAX_VALUE_BYTES                     = 64
+
+DEFAULT_RING_SLOTS                  = 256
+
+# Restart backoff for a worker that keeps dying
+RESTART_MIN_SECONDS                 = 1
+RESTART_MAX_SECONDS                 = 60
+
+log = logging.getLogger(__name__)
+
+
+class ReadingRing(object):
+
+    def __init__(self,shm,slots):
+        self.shm = shm
+        self.buf = shm.buf
+        self.slots = slots
+        self.count = 0
+
+    @classmethod
+    def create(cls,slots=DEFAULT_RING_SLOTS):
+        shm = shared_memory.SharedMemory(create=True,size=HEADER_SIZE + (slots * SLOT_SIZE))
+        struct.pack_into(HEADER_FORMAT,shm.buf,0,0)
+        return cls(shm,slots)
+
+    # The server owns the segment. Left tracked, the worker's resource
+    # tracker would unlink it when the worker dies, and the restarted worker
+    # would have nothing to attach to.
+    @classmethod
+    def attach(cls,name,slots):
+        if sys.version_info >= (3,13):
+            shm = shared_memory.SharedMemory(name=name,track=False)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name,'shared_memory')
+        return cls(shm,slots)
+
+    def get_name(self):
+        return self.shm.name
+
+    def write(self,uuid,value):
+        uuid = uuid.encode('utf-8')
+        value = value.encode('utf-8')
+        if len(uuid) > MAX_UUID_BYTES or len(value) > MAX_VALUE_BYTES:
+            log.error('[ReadingRing:write] Reading too large for ring: ' + str(uuid))
+            return
+        offset = HEADER_SIZE + ((self.count % self.slots) * SLOT_SIZE)
+        seq = (self.count * 2) + 1
+        struct.pack_into(SEQ_FORMAT,self.buf,offset,seq)
+        struct.pack_into(BODY_FORMAT,self.buf,offset + SEQ_SIZE,uuid,len(value),value)
+        struct.pack_into(SEQ_FORMAT,self.buf,offset,seq + 1)
+        self.count += 1
+        struct.pack_into(HEADER_FORMAT,self.buf,0,self.count)
+
+    # Returns (uuid,value) pairs written since the last call
+    def read_new(self):
+        rv = list()
+        written, = struct.unpack_from(HEADER_FORMAT,self.buf,0)
+        if written < self.count:
+            # The worker was restarted with a fresh counter
+            self.count = 0
+        if (written - self.count) > self.slots:
+            log.warning('[ReadingRing:read_new] Dropped ' + str(written - self.count - self.slots) + ' readings')
+            self.count = written - self.slots
+        while self.count < written:
+            offset = HEADER_SIZE + ((self.count % self.slots) * SLOT_SIZE)
+            expected = (self.count + 1) * 2
+            seq, = struct.unpack_from(SEQ_FORMAT,self.buf,offset)
+            if expected == seq:
+                uuid,n,value = struct.unpack_from(BODY_FORMAT,self.buf,offset + SEQ_SIZE)
+                seq, = struct.unpack_from(SEQ_FORMAT,self.buf,offset)
+                if expected == seq:
+                    rv.append((uuid.rstrip(b'\0').decode('utf-8'),value[:n].decode('utf-8')))
+            self.count += 1
+        return rv
+
+    def reset(self):
+        struct.pack_into(HEADER_FORMAT,self.buf,0,0)
+        self.count = 0
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+# Stands in for push_plugins.SampleSink inside a worker. Samples go straight
+# into the ring and reach the server on its next collection cycle.
+class RingSink(object):
+
+    def __init__(self,ring):
+        self.ring = ring
+        self.lock = threading.Lock()
+
+    def send_nowait(self,uuid,value,timestamp=None,digits=None):
+        sample = push_plugins.Sample(uuid,value,timestamp,digits)
+        with self.lock:
+            self.ring.write(sample.uuid,sample.format())
+
+    async def send(self,uuid,value,timestamp=None,digits=None):
+        self.send_nowait(uuid,value,timestamp,digits)
+
+    def send_threadsafe(self,uuid,value,timestamp=None,digits=None):
+        self.send_nowait(uuid,value,timestamp,digits)
+
+
+async def run_push_worker(plugin,ring,parent):
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(plugin.run,RingSink(ring))
+        while parent == os.getppid():
+            await trio.sleep(1)
+        nursery.cancel_scope.cancel()
+
+# Entry point of the worker process
+def worker_main(module_name,ring_name,slots,update_seconds):
+    parent = os.getppid()
+    ring = ReadingRing.attach(ring_name,slots)
+    mod = import_module(module_name)
+    plugin = mod.load()
+    if True == push_plugins.is_push_plugin(plugin):
+        trio.run(run_push_worker,plugin,ring,parent)
+        return
+    pipeline = None
+    if True == sample_pipeline.uses_pipeline(plugin):
+        try:
+            pipeline = sample_pipeline.Pipeline()
+            pipeline.add_plugin(plugin)
+        except RuntimeError as e:
+            # As in the server, carry on with the plugin's formatted values
+            log.error('Raw samples from ' + module_name + ' will be ignored: ' + str(e))
+            pipeline = None
+    # Exit rather than linger if the server goes away
+    while parent == os.getppid():
+        for x in sample_pipeline.plugin_values(plugin,pipeline):
+            if 2 == len(x):
+                ring.write(x[0],x[1])
+        time.sleep(update_seconds)
+
+
+class PluginWorker(object):
+
+    def __init__(self,module_name,update_seconds,slots=DEFAULT_RING_SLOTS):
+        self.module_name = module_name
+        self.update_seconds = update_seconds
+        self.slots = slots
+        self.ring = None
+        self.process = None
+        self.restarts = 0
+        self.started_at = None
+        self.next_start = 0
+        self.backoff = RESTART_MIN_SECONDS
+
+    # A fresh interpreter that doesn't inherit the server's trio and D-Bus
+    # state. The plugins package is found through the working directory,
+    # which -m puts on sys.path, and this module through PYTHONPATH.
+    def start(self):
+        if None is self.ring:
+            self.ring = ReadingRing.create(self.slots)
+        self.ring.reset()
+        env = dict(os.environ)
+        here = os.path.dirname(os.path.abspath(__file__))
+        env['PYTHONPATH'] = here + os.pathsep + env['PYTHONPATH'] if 'PYTHONPATH' in env else here
+        args = [sys.executable,'-m','plugin_worker',self.module_name,self.ring.get_name(),str(self.slots),str(self.update_seconds)]
+        self.process = subprocess.Popen(args,env=env)
+        self.started_at = time.monotonic()
+        log.info('Started worker for ' + self.module_name + ' (pid ' + str(self.process.pid) + ')')
+
+    def is_alive(self):
+        return None is not self.process and None is self.process.poll()
+
+    # Called periodically by the server. Restarts a dead worker, backing off
+    # if it keeps dying soon after starting.
+    def check(self):
+        if True == self.is_alive():
+            return
+        now = time.monotonic()
+        if None is not self.process:
+            log.error('Worker for ' + self.module_name + ' exited with code ' + str(self.process.returncode))
+            self.process = None
+            if (now - self.started_at) > RESTART_MAX_SECONDS:
+                self.backoff = RESTART_MIN_SECONDS
+            self.next_start = now + self.backoff
+            self.backoff = min(self.backoff * 2,RESTART_MAX_SECONDS)
+        if now >= self.next_start:
+            self.restarts += 1
+            self.start()
+
+    def read_new(self):
+        rv = list()
+        if None is not self.ring:
+            rv = self.ring.read_new()
+        return rv
+
+    def stop(self):
+        if None is not self.process:
+            self.process.terminate()
+            try:
+                self.process.wait(1)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+        if None is not self.ring:
+            self.ring.unlink()
+            self.ring = None
+
+
+if '__main__' == __name__:
+    logging.basicConfig(level=logging.INFO)
+    worker_main(sys.argv[1],sys.argv[2],int(sys.argv[3]),float(sys.argv[4]))
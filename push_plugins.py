@@ -0,0 +1,126 @@
+"""
+    push_plugins.py
+    Support for plugins that push samples as they arrive
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    A push plugin's load() returns an object with an async run(sink) method.
+    The server runs it as a trio task for as long as the server is up
+    (restarting it if it raises), and run() reports samples whenever it has
+    them:
+
+        await sink.send(uuid,value)          from run() or any trio task
+        sink.send_nowait(uuid,value)         from synchronous code in the
+                                             trio thread
+        sink.send_threadsafe(uuid,value)     from other threads, such as
+                                             GPIO interrupt callbacks
+
+    value may be an int, float, bool or str, and all three take optional
+    timestamp (seconds, as from time.time(); defaults to now) and digits
+    (decimal places for floats) arguments. The server stores each sample the
+    moment it arrives instead of waiting for the next poll.
+"""
+
+import time
+import inspect
+import logging
+import trio
+
+DEFAULT_DIGITS                      = 2
+QUEUE_SIZE                          = 256
+RESTART_SECONDS                     = 5
+
+log = logging.getLogger(__name__)
+
+
+class Sample(object):
+
+    __slots__ = ('uuid','value','timestamp','digits')
+
+    def __init__(self,uuid,value,timestamp=None,digits=None):
+        if not isinstance(value,(int,float,str)):
+            raise TypeError('Unsupported sample type: ' + type(value).__name__)
+        self.uuid = uuid
+        self.value = value
+        self.timestamp = time.time() if None is timestamp else timestamp
+        self.digits = DEFAULT_DIGITS if None is digits else digits
+
+    # The string form the rest of the server stores and serves
+    def format(self):
+        if isinstance(self.value,bool):
+            return '1' if self.value else '0'
+        if isinstance(self.value,float):
+            return '%.*f' % (self.digits,self.value)
+        return str(self.value)
+
+
+class SampleSink(object):
+
+    def __init__(self,send_channel,name):
+        self.send_channel = send_channel
+        self.name = name
+        self.token = trio.lowlevel.current_trio_token()
+        self.dropped = 0
+
+    async def send(self,uuid,value,timestamp=None,digits=None):
+        await self.send_channel.send(Sample(uuid,value,timestamp,digits))
+
+    def send_nowait(self,uuid,value,timestamp=None,digits=None):
+        self.put(Sample(uuid,value,timestamp,digits))
+
+    def put(self,sample):
+        try:
+            self.send_channel.send_nowait(sample)
+        except trio.WouldBlock:
+            self.dropped += 1
+            log.warning('[SampleSink:put] Queue full, dropped a sample from ' + self.name)
+
+    # Run by trio from run_sync_soon(), where an exception would end the
+    # whole run, so nothing may escape
+    def put_threadsafe(self,sample):
+        try:
+            self.put(sample)
+        except Exception:
+            log.exception('[SampleSink:put_threadsafe] Lost a sample from ' + self.name)
+
+    # Returns straight away rather than waiting for the trio thread, so an
+    # interrupt callback isn't held up by whatever the loop is doing. The
+    # sample is checked here, so a bad value raises TypeError in the calling
+    # thread.
+    def send_threadsafe(self,uuid,value,timestamp=None,digits=None):
+        # Stamped here, the trio thread may not get to it straight away
+        sample = Sample(uuid,value,timestamp,digits)
+        try:
+            self.token.run_sync_soon(self.put_threadsafe,sample)
+        except trio.RunFinishedError:
+            pass
+
+
+def is_push_plugin(plugin):
+    return hasattr(plugin,'run') and inspect.iscoroutinefunction(plugin.run)
+
+# Runs a push plugin until cancelled, restarting it if it fails
+async def run_plugin(plugin,send_channel,name):
+    sink = SampleSink(send_channel,name)
+    while True:
+        try:
+            await plugin.run(sink)
+            log.info('Push plugin ' + name + ' finished')
+            return
+        except Exception:
+            log.exception('Push plugin ' + name + ' failed, restarting in ' + str(RESTART_SECONDS) + ' seconds')
+        await trio.sleep(RESTART_SECONDS)
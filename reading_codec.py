@@ -0,0 +1,284 @@
+"""
+    reading_codec.py
+    Compact binary encoding for blocks of readings
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    A block holds rows of readings taken at the same times, stored column by
+    column. Timestamps are whole milliseconds, stored as the first value, the
+    first delta and then deltas of deltas, so a steady sampling interval costs
+    one byte per row. Values are fixed-point integers (value * 10^digits)
+    stored as the first value followed by deltas. Every integer is a zigzag
+    LEB128 varint, so small changes in either direction take a single byte.
+
+    Block layout:
+
+        'CCSR'                      magic
+        u8                          version (1)
+        varint                      row count
+        varint                      column count
+        zigzag varints              timestamps, as above
+        for each column:
+            varint + bytes          column name (utf-8)
+            u8                      digits
+            u8                      flags, bit 0 set if some rows are missing
+            bytes                   presence bitmap, one bit per row (LSB
+                                    first), only if flag bit 0 is set
+            zigzag varints          values of the rows that are present
+
+    decode_block() is deliberately self-contained so it can serve as the
+    reference for client implementations.
+
+    Run this file directly for a size and speed comparison against plain text.
+"""
+
+MAGIC                               = b'CCSR'
+VERSION                             = 1
+DEFAULT_DIGITS                      = 2
+FLAG_SPARSE                         = 0x01
+
+
+class CodecError(Exception):
+    pass
+
+
+def zigzag(n):
+    if n >= 0:
+        return n << 1
+    return ((-n) << 1) - 1
+
+def unzigzag(n):
+    if n & 1:
+        return -((n + 1) >> 1)
+    return n >> 1
+
+def put_varint(out,n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def get_varint(buf,idx):
+    rv = 0
+    shift = 0
+    while True:
+        if idx >= len(buf):
+            raise CodecError('Truncated varint')
+        b = buf[idx]
+        idx += 1
+        rv |= (b & 0x7f) << shift
+        if 0 == (b & 0x80):
+            return rv,idx
+        shift += 7
+
+# Splits a reading such as '21.37' into its float value and decimal places.
+# Returns None for anything that isn't a plain number.
+def parse_reading(s):
+    try:
+        v = float(s)
+    except (TypeError,ValueError):
+        return None
+    if v != v or v in (float('inf'),float('-inf')):
+        return None
+    digits = 0
+    if isinstance(s,str):
+        s = s.strip()
+        if 'e' not in s.lower() and '.' in s:
+            digits = len(s) - s.index('.') - 1
+    else:
+        digits = DEFAULT_DIGITS
+    return v,digits
+
+# timestamps: seconds (as from time.time()), one per row
+# columns   : {name: [value or None, ...]}, one value per row
+# digits    : {name: decimal places}, DEFAULT_DIGITS for names not listed
+def encode_block(timestamps,columns,digits=None):
+    if None is digits:
+        digits = dict()
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    n = len(timestamps)
+    put_varint(out,n)
+    put_varint(out,len(columns))
+
+    prev = 0
+    prev_delta = 0
+    for i,t in enumerate(timestamps):
+        t = int(round(t * 1000))
+        if 0 == i:
+            put_varint(out,zigzag(t))
+        else:
+            delta = t - prev
+            if 1 == i:
+                put_varint(out,zigzag(delta))
+            else:
+                put_varint(out,zigzag(delta - prev_delta))
+            prev_delta = delta
+        prev = t
+
+    for name,values in columns.items():
+        if len(values) != n:
+            raise CodecError('Column ' + str(name) + ' has ' + str(len(values)) + ' values for ' + str(n) + ' rows')
+        d = digits.get(name,DEFAULT_DIGITS)
+        scale = 10 ** d
+        encoded_name = name.encode('utf-8')
+        put_varint(out,len(encoded_name))
+        out.extend(encoded_name)
+        out.append(d)
+        if None in values:
+            out.append(FLAG_SPARSE)
+            bitmap = bytearray((n + 7) // 8)
+            for i,v in enumerate(values):
+                if None is not v:
+                    bitmap[i >> 3] |= 1 << (i & 7)
+            out.extend(bitmap)
+        else:
+            out.append(0)
+        prev = 0
+        for v in values:
+            if None is not v:
+                x = int(round(v * scale))
+                put_varint(out,zigzag(x - prev))
+                prev = x
+    return bytes(out)
+
+# Returns (timestamps,columns,digits) in the same form encode_block() takes
+def decode_block(buf):
+    if len(buf) < 5 or MAGIC != bytes(buf[:4]):
+        raise CodecError('Not a reading block')
+    if VERSION != buf[4]:
+        raise CodecError('Unsupported block version: ' + str(buf[4]))
+    idx = 5
+    n,idx = get_varint(buf,idx)
+    ncols,idx = get_varint(buf,idx)
+
+    timestamps = list()
+    t = 0
+    delta = 0
+    for i in range(n):
+        x,idx = get_varint(buf,idx)
+        x = unzigzag(x)
+        if 0 == i:
+            t = x
+        elif 1 == i:
+            delta = x
+            t += delta
+        else:
+            delta += x
+            t += delta
+        timestamps.append(t / 1000)
+
+    columns = dict()
+    digits = dict()
+    for c in range(ncols):
+        length,idx = get_varint(buf,idx)
+        name = bytes(buf[idx:idx + length]).decode('utf-8')
+        idx += length
+        if idx + 2 > len(buf):
+            raise CodecError('Truncated column header')
+        d = buf[idx]
+        flags = buf[idx + 1]
+        idx += 2
+        present = None
+        if flags & FLAG_SPARSE:
+            size = (n + 7) // 8
+            present = buf[idx:idx + size]
+            idx += size
+        scale = 10 ** d
+        values = list()
+        x = 0
+        for i in range(n):
+            if None is not present and 0 == (present[i >> 3] & (1 << (i & 7))):
+                values.append(None)
+                continue
+            delta,idx = get_varint(buf,idx)
+            x += unzigzag(delta)
+            values.append(x / scale)
+        columns[name] = values
+        digits[name] = d
+    return timestamps,columns,digits
+
+# The format this codec replaces, for comparison: one 'time,name,value' line
+# per reading
+def encode_text(timestamps,columns,digits=None):
+    if None is digits:
+        digits = dict()
+    lines = list()
+    for i,t in enumerate(timestamps):
+        for name,values in columns.items():
+            v = values[i]
+            if None is not v:
+                lines.append('%.3f,%s,%.*f' % (t,name,digits.get(name,DEFAULT_DIGITS),v))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def benchmark(rows=8640,interval=10,repeat=5):
+    import time
+    import zlib
+    import random
+
+    rnd = random.Random(1)
+    start = time.time()
+    timestamps = list()
+    temperature = list()
+    humidity = list()
+    pressure = list()
+    t,h,p = 18.0,55.0,1013.25
+    for i in range(rows):
+        # Occasional scheduling jitter on the timestamps
+        timestamps.append(start + (i * interval) + (0.001 * rnd.randint(-3,3)))
+        t += rnd.gauss(0,0.02)
+        h += rnd.gauss(0,0.05)
+        p += rnd.gauss(0,0.01)
+        temperature.append(round(t,2))
+        humidity.append(round(h,1))
+        pressure.append(round(p,2))
+    columns = {
+        'a0ce0210-3bbf-11ee-89eb-00e04c400cc5': temperature,
+        'a0ce0211-3bbf-11ee-89eb-00e04c400cc5': humidity,
+        'a0ce0212-3bbf-11ee-89eb-00e04c400cc5': pressure,
+    }
+    digits = {'a0ce0211-3bbf-11ee-89eb-00e04c400cc5': 1}
+
+    def timed(f,*args):
+        best = None
+        for r in range(repeat):
+            t0 = time.perf_counter()
+            rv = f(*args)
+            elapsed = time.perf_counter() - t0
+            if None is best or elapsed < best:
+                best = elapsed
+        return rv,best
+
+    text,text_time = timed(encode_text,timestamps,columns,digits)
+    packed,text_zlib_time = timed(zlib.compress,text,9)
+    block,block_time = timed(encode_block,timestamps,columns,digits)
+    decoded,decode_time = timed(decode_block,block)
+
+    readings = rows * len(columns)
+    print('%d rows x %d columns (%d readings)' % (rows,len(columns),readings))
+    print('%-12s %10s %10s %12s' % ('format','bytes','B/reading','encode ms'))
+    print('%-12s %10d %10.2f %12.1f' % ('text',len(text),len(text) / readings,text_time * 1000))
+    print('%-12s %10d %10.2f %12.1f' % ('text+zlib',len(packed),len(packed) / readings,(text_time + text_zlib_time) * 1000))
+    print('%-12s %10d %10.2f %12.1f' % ('block',len(block),len(block) / readings,block_time * 1000))
+    print('block is %.1fx smaller than text, decode took %.1f ms' % (len(text) / len(block),decode_time * 1000))
+    if decoded[1] != columns:
+        print('WARNING: decoded values differ from the input')
+
+
+if '__main__' == __name__:
+    benchmark()
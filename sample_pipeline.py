@@ -0,0 +1,176 @@
+"""
+    sample_pipeline.py
+    Turns batches of raw sensor samples into readings
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    Requires NumPy, which is optional for the data station as a whole.
+
+    Besides get_current_values(), a plugin may implement:
+
+        get_raw_samples()      returns a list of (uuid,samples) pairs, where
+                               samples is a 1-D sequence of raw readings for
+                               one channel, or a list of (uuids,samples) pairs
+                               where samples is 2-D, one row per uuid
+        get_channel_settings() returns {uuid: settings} and is called once
+                               when the plugin is loaded
+
+    Settings for a channel (all optional):
+
+        scale, offset  linear calibration, applied as raw * scale + offset
+        convert        unit conversion applied after calibration, one of
+                       the names in CONVERSIONS
+        reduce         'median' (default) or 'mean'
+        reject         reject samples further than this many (scaled) median
+                       absolute deviations from the median, 0 disables
+        digits         decimal places in the reported value
+
+    Each batch is processed as whole arrays, so oversampling a channel 16x
+    or more costs a handful of NumPy calls rather than a Python loop per
+    sample.
+"""
+
+import logging
+
+# NumPy is slow to import on a Pi Zero, so it is only loaded once a plugin
+# actually hands us raw samples
+np = None
+
+# name: (scale,offset)
+CONVERSIONS = {
+    'c_to_f'     : (9.0 / 5.0,32.0),
+    'c_to_k'     : (1.0,273.15),
+    'pa_to_hpa'  : (0.01,0.0),
+    'pa_to_inhg' : (1.0 / 3386.389,0.0),
+    'mps_to_kph' : (3.6,0.0),
+    'mps_to_mph' : (2.2369363,0.0),
+    'mm_to_in'   : (1.0 / 25.4,0.0),
+}
+
+DEFAULT_REDUCE                      = 'median'
+DEFAULT_REJECT                      = 3.5
+DEFAULT_DIGITS                      = 2
+
+# Scales the median absolute deviation to a standard deviation for normal data
+MAD_SCALE                           = 1.4826
+
+log = logging.getLogger(__name__)
+
+
+class ChannelSettings(object):
+
+    __slots__ = ('scale','offset','reduce','reject','digits')
+
+    def __init__(self,scale=1.0,offset=0.0,convert=None,reduce=DEFAULT_REDUCE,reject=DEFAULT_REJECT,digits=DEFAULT_DIGITS):
+        if reduce not in ('median','mean'):
+            raise ValueError('Unknown reduction: ' + str(reduce))
+        # Fold the unit conversion into the calibration so a batch only
+        # needs one multiply and one add
+        if None is not convert:
+            if convert not in CONVERSIONS:
+                raise ValueError('Unknown conversion: ' + str(convert))
+            cscale,coffset = CONVERSIONS[convert]
+            offset = (offset * cscale) + coffset
+            scale = scale * cscale
+        self.scale = scale
+        self.offset = offset
+        self.reduce = reduce
+        self.reject = reject
+        self.digits = digits
+
+
+class Pipeline(object):
+
+    def __init__(self):
+        global np
+        if None is np:
+            try:
+                import numpy as np
+            except ImportError:
+                raise RuntimeError('The sample pipeline requires NumPy')
+        self.channels = dict()
+        self.default = ChannelSettings()
+
+    def configure(self,uuid,**kwargs):
+        self.channels[uuid] = ChannelSettings(**kwargs)
+
+    def add_plugin(self,plugin):
+        if hasattr(plugin,'get_channel_settings'):
+            for uuid,settings in plugin.get_channel_settings().items():
+                self.configure(uuid,**settings)
+
+    def get_settings(self,uuid):
+        return self.channels.get(uuid,self.default)
+
+    # samples has one row per uuid. Returns a list of (uuid,value) pairs.
+    def process(self,uuids,samples):
+        rv = list()
+        a = np.asarray(samples,dtype=np.float64)
+        if 1 == a.ndim:
+            a = a.reshape(1,-1)
+        if 0 == a.size:
+            return rv
+        if 2 != a.ndim or len(uuids) != a.shape[0]:
+            raise ValueError('Expected %d rows of samples, got shape %s' % (len(uuids),str(a.shape)))
+        settings = [self.get_settings(u) for u in uuids]
+
+        scale = np.array([x.scale for x in settings]).reshape(-1,1)
+        offset = np.array([x.offset for x in settings]).reshape(-1,1)
+        a = (a * scale) + offset
+
+        reject = np.array([x.reject for x in settings]).reshape(-1,1)
+        median = np.median(a,axis=1,keepdims=True)
+        deviation = np.abs(a - median)
+        mad = np.median(deviation,axis=1,keepdims=True) * MAD_SCALE
+        # With no spread, as when most of an oversampled ADC's codes are
+        # identical, only samples equal to the median are kept, so a single
+        # spike can't reach a mean
+        keep = (deviation <= (reject * mad)) | (0 >= reject)
+        kept = np.where(keep,a,np.nan)
+
+        use_mean = np.array([('mean' == x.reduce) for x in settings])
+        reduced = np.where(use_mean,np.nanmean(kept,axis=1),np.nanmedian(kept,axis=1))
+
+        for uuid,s,v in zip(uuids,settings,reduced.tolist()):
+            rv.append((uuid,'{:.{}f}'.format(v,s.digits)))
+        return rv
+
+    def process_batches(self,batches):
+        rv = list()
+        for uuids,samples in batches:
+            if isinstance(uuids,str):
+                uuids = (uuids,)
+            # A malformed batch from one plugin shouldn't cost the others
+            try:
+                rv.extend(self.process(uuids,samples))
+            except (ValueError,TypeError) as e:
+                log.error('[Pipeline:process_batches] Skipped a batch for ' + ','.join(uuids) + ': ' + str(e))
+        return rv
+
+
+# Collects a plugin's readings, running any raw samples through the pipeline
+def plugin_values(plugin,pipeline):
+    rv = list()
+    if hasattr(plugin,'get_current_values'):
+        rv.extend(plugin.get_current_values())
+    if None is not pipeline and hasattr(plugin,'get_raw_samples'):
+        rv.extend(pipeline.process_batches(plugin.get_raw_samples()))
+    return rv
+
+
+def uses_pipeline(plugin):
+    return hasattr(plugin,'get_raw_samples')
@@ -0,0 +1,104 @@
+"""
+    sampling_profiler.py
+    Low overhead sampling profiler for the running server
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    A background thread wakes every SAMPLE_SECONDS, grabs the stack of the
+    trio thread with sys._current_frames() and counts identical stacks. The
+    server itself isn't traced or paused, so clients stay connected. Each
+    stack is prefixed with the trio task that was running, taken from the
+    loop monitor's instrument, or '<idle>' when trio was waiting for I/O.
+
+    The output uses the collapsed stack format ("task;outer;...;inner
+    count" per line), which flamegraph.pl, speedscope and inferno read
+    directly.
+"""
+
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+
+SAMPLE_SECONDS                      = 0.01
+MAX_SECONDS                         = 300
+OUTPUT_DIR                          = '/tmp'
+
+log = logging.getLogger(__name__)
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class SamplingProfiler(object):
+
+    # current_task returns the trio task running right now, or None
+    def __init__(self,current_task):
+        self.current_task = current_task
+        self.thread = None
+
+    def is_running(self):
+        return None is not self.thread and self.thread.is_alive()
+
+    # Must be called from the trio thread. Returns the path the results will
+    # be written to once the run is over. The file is created here, with a
+    # name nobody can guess in advance, since we run as root and OUTPUT_DIR
+    # is usually world writable.
+    def start(self,seconds):
+        if True == self.is_running():
+            raise ProfilerBusy('A profile is already running')
+        seconds = max(1,min(seconds,MAX_SECONDS))
+        fd,path = tempfile.mkstemp(suffix='.folded',prefix=time.strftime('ccs_profile_%Y%m%d_%H%M%S_'),dir=OUTPUT_DIR)
+        target = threading.get_ident()
+        self.thread = threading.Thread(target=self.run,args=(target,seconds,fd,path),name='sampling-profiler',daemon=True)
+        self.thread.start()
+        log.info('Profiling for ' + str(seconds) + ' seconds into ' + path)
+        return path
+
+    def label(self,frame):
+        code = frame.f_code
+        name = getattr(code,'co_qualname',code.co_name)
+        return '%s:%s' % (os.path.basename(code.co_filename),name)
+
+    def run(self,target,seconds,fd,path):
+        counts = dict()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(target)
+            if None is frame:
+                break
+            task = self.current_task()
+            stack = list()
+            while None is not frame:
+                stack.append(self.label(frame))
+                frame = frame.f_back
+            stack.append('<idle>' if None is task else task.name)
+            # Drop our own references before sleeping
+            frame = None
+            task = None
+            key = ';'.join(reversed(stack)).replace(' ','_')
+            counts[key] = counts.get(key,0) + 1
+            samples += 1
+            time.sleep(SAMPLE_SECONDS)
+        with os.fdopen(fd,'w') as f:
+            for key,n in sorted(counts.items()):
+                f.write('%s %d\n' % (key,n))
+        log.info('Profile done, %d samples in %d stacks written to %s',samples,len(counts),path)
@@ -0,0 +1,135 @@
+"""
+    startup_profile.py
+    Measures where the data station spends its time while starting up
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    install() must run before the imports being measured. It wraps
+    __import__ to time every module the first time it is imported, in the
+    same spirit as python -X importtime but summarised per top-level import.
+    milestone() records how long after process start a stage was reached, and
+    report() logs both once the server is advertising.
+"""
+
+import os
+import sys
+import time
+import builtins
+import logging
+
+REPORT_COUNT                        = 15
+
+g_enabled = False
+g_original_import = None
+g_stack = list()
+# (depth,name,self seconds,cumulative seconds)
+g_imports = list()
+# (name,seconds since process start)
+g_milestones = list()
+g_reported = False
+g_installed_at = 0.0
+
+log = logging.getLogger(__name__)
+
+
+# The absolute name of a relative import such as 'from . import x'
+def _resolve(name,globals,level):
+    if 0 == level:
+        return name
+    package = ''
+    if None is not globals:
+        package = globals.get('__package__') or ''
+    if level > 1:
+        package = package.rsplit('.',level - 1)[0]
+    if '' == name:
+        return package
+    if '' == package:
+        return name
+    return package + '.' + name
+
+def _timed_import(name,globals=None,locals=None,fromlist=(),level=0):
+    if 0 == level and name in sys.modules:
+        return g_original_import(name,globals,locals,fromlist,level)
+    start = time.perf_counter()
+    g_stack.append(0.0)
+    try:
+        return g_original_import(name,globals,locals,fromlist,level)
+    finally:
+        elapsed = time.perf_counter() - start
+        children = g_stack.pop()
+        if len(g_stack) > 0:
+            g_stack[-1] += elapsed
+        # Anything faster than this was already loaded
+        if elapsed > 0.0001:
+            g_imports.append((len(g_stack),_resolve(name,globals,level),elapsed - children,elapsed))
+
+# Seconds between the kernel starting this process and now, which includes
+# the interpreter's own startup. Falls back to time since install().
+def _process_age():
+    try:
+        with open('/proc/self/stat') as f:
+            fields = f.read().rsplit(')',1)[1].split()
+        # starttime is field 22, counted in clock ticks since boot
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - started
+    except (OSError,ValueError,IndexError,AttributeError):
+        return time.perf_counter() - g_installed_at
+
+def install():
+    global g_enabled
+    global g_original_import
+    global g_installed_at
+    if True == g_enabled:
+        return
+    g_enabled = True
+    g_installed_at = time.perf_counter()
+    g_original_import = builtins.__import__
+    builtins.__import__ = _timed_import
+    milestone('profiling started')
+
+def uninstall():
+    if None is not g_original_import:
+        builtins.__import__ = g_original_import
+
+def milestone(name):
+    if True == g_enabled:
+        g_milestones.append((name,_process_age()))
+
+def report():
+    global g_reported
+    if False == g_enabled or True == g_reported:
+        return
+    g_reported = True
+    uninstall()
+    lines = list()
+    lines.append('Startup milestones (seconds since process start):')
+    for name,t in g_milestones:
+        lines.append('  %8.3f  %s' % (t,name))
+    top = [x for x in g_imports if 0 == x[0]]
+    top.sort(key=lambda x: x[3],reverse=True)
+    total = sum([x[3] for x in top])
+    lines.append('Slowest top-level imports (%.3f seconds in all):' % total)
+    lines.append('  %8s  %8s  %s' % ('cumul','self','module'))
+    for depth,name,own,cumulative in top[:REPORT_COUNT]:
+        lines.append('  %8.3f  %8.3f  %s' % (cumulative,own,name))
+    inner = sorted(g_imports,key=lambda x: x[2],reverse=True)
+    lines.append('Most expensive modules by self time:')
+    for depth,name,own,cumulative in inner[:REPORT_COUNT]:
+        lines.append('  %8.3f  %s' % (own,name))
+    s = '\n'.join(lines)
+    log.info(s)
+    print(s)
@@ -0,0 +1,307 @@
+"""
+    uplink.py
+    Store-and-forward upload of readings over a network link
+
+    Copyright (C) 2025 Clear Creek Scientific
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+*********************************
+    Each collection cycle becomes a row. Rows are gathered into batches,
+    encoded with reading_codec and written to a spool directory, one file per
+    batch, before anything is sent. Files are then POSTed to the configured
+    URL oldest first and deleted once the endpoint answers 2xx. Failed uploads
+    are retried with exponential backoff, and because the spool lives on disk
+    an outage or a restart only delays data. The spool is capped at
+    MAX_SPOOL_FILES, beyond which the oldest batches are dropped.
+
+    A batch the endpoint refuses outright (a 4xx other than 408 or 429) would
+    never succeed and would hold up everything behind it, so it is moved to
+    REJECTED_DIR inside the spool instead. If the spool can't be written, for
+    example because the card is full, rows stay in memory (up to
+    MAX_PENDING_ROWS) and the write is retried with the same backoff.
+
+    Disk and network I/O run in worker threads so the trio loop never waits
+    on them.
+
+    For testing, "python uplink.py --serve PORT" runs a stand-in endpoint
+    that decodes and prints whatever it receives.
+"""
+
+import os
+import time
+import random
+import logging
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+import trio
+
+import reading_codec
+
+CONTENT_TYPE                        = 'application/vnd.clearcreeksci.readings'
+SPOOL_SUFFIX                        = '.ccsr'
+DEFAULT_SPOOL_DIR                   = 'uplink_spool'
+REJECTED_DIR                        = 'rejected'
+BATCH_ROWS                          = 60
+FLUSH_SECONDS                       = 600
+MAX_SPOOL_FILES                     = 10000
+MAX_REJECTED_FILES                  = 100
+MAX_PENDING_ROWS                    = 1440
+# Client errors that are worth retrying
+RETRY_STATUS                        = (408,429)
+HTTP_TIMEOUT_SECONDS                = 30
+RETRY_MIN_SECONDS                   = 5
+RETRY_MAX_SECONDS                   = 900
+IDLE_SECONDS                        = 5
+
+log = logging.getLogger(__name__)
+
+
+class UplinkError(Exception):
+    pass
+
+
+# The endpoint will never accept this batch
+class UplinkRejected(UplinkError):
+    pass
+
+
+class UplinkExporter(object):
+
+    def __init__(self,url,spool_dir=DEFAULT_SPOOL_DIR,batch_rows=BATCH_ROWS,flush_seconds=FLUSH_SECONDS,max_files=MAX_SPOOL_FILES):
+        # Caught here rather than on every upload attempt
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http','https') or '' == parts.netloc:
+            raise UplinkError('Not an http or https URL: ' + str(url))
+        self.url = url
+        self.spool_dir = spool_dir
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.max_files = max_files
+        # (timestamp,{uuid: (value,digits)})
+        self.rows = list()
+        self.first_row_at = None
+        self.backoff = RETRY_MIN_SECONDS
+        self.uploaded = 0
+        self.failures = 0
+        if False == os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir,mode=0o755)
+        self.next_seq = self.find_next_seq()
+        self.station = None
+
+    def find_next_seq(self):
+        rv = 0
+        for name in self.spool_files():
+            rv = max(rv,int(name[:-len(SPOOL_SUFFIX)]) + 1)
+        return rv
+
+    # Oldest first
+    def spool_files(self):
+        rv = list()
+        for name in os.listdir(self.spool_dir):
+            if name.endswith(SPOOL_SUFFIX) and name[:-len(SPOOL_SUFFIX)].isdigit():
+                rv.append(name)
+        rv.sort()
+        return rv
+
+    def add_row(self,timestamp,readings):
+        row = dict()
+        for uuid,value in readings:
+            parsed = reading_codec.parse_reading(value)
+            if None is not parsed:
+                row[uuid] = parsed
+        if len(row) > 0:
+            if 0 == len(self.rows):
+                self.first_row_at = time.monotonic()
+            elif len(self.rows) >= MAX_PENDING_ROWS:
+                # Only while the spool can't be written
+                self.rows.pop(0)
+                log.warning('[UplinkExporter:add_row] Too many rows waiting, dropped the oldest')
+            self.rows.append((timestamp,row))
+
+    def flush_due(self):
+        if 0 == len(self.rows):
+            return False
+        return len(self.rows) >= self.batch_rows or (time.monotonic() - self.first_row_at) >= self.flush_seconds
+
+    # Rows stay in self.rows until the block is safely on disk, see
+    # rows_written()
+    def make_block(self,rows):
+        timestamps = list()
+        columns = dict()
+        digits = dict()
+        for i,(t,row) in enumerate(rows):
+            timestamps.append(t)
+            for uuid,(v,d) in row.items():
+                if uuid not in columns:
+                    columns[uuid] = [None] * len(rows)
+                    digits[uuid] = d
+                columns[uuid][i] = v
+                digits[uuid] = max(digits[uuid],d)
+        return reading_codec.encode_block(timestamps,columns,digits)
+
+    # rows is the list the block was made from. add_row() may have dropped
+    # some of them since, so only the ones still waiting are removed.
+    def rows_written(self,rows):
+        written = set(id(row) for row in rows)
+        self.rows = [row for row in self.rows if id(row) not in written]
+        self.first_row_at = time.monotonic() if len(self.rows) > 0 else None
+
+    # Blocking, run in a thread
+    def write_block(self,block):
+        name = '%012d%s' % (self.next_seq,SPOOL_SUFFIX)
+        self.next_seq += 1
+        path = os.path.join(self.spool_dir,name)
+        tmp = path + '.tmp'
+        os.makedirs(self.spool_dir,mode=0o755,exist_ok=True)
+        try:
+            with open(tmp,'wb') as f:
+                f.write(block)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp,path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        files = self.spool_files()
+        while len(files) > self.max_files:
+            log.warning('[UplinkExporter:write_block] Spool full, dropping ' + files[0])
+            os.remove(os.path.join(self.spool_dir,files.pop(0)))
+
+    # Blocking, run in a thread
+    def upload(self,name):
+        path = os.path.join(self.spool_dir,name)
+        with open(path,'rb') as f:
+            block = f.read()
+        if None is self.station:
+            import platform
+            self.station = platform.node()
+        req = urllib.request.Request(self.url,data=block,method='POST')
+        req.add_header('Content-Type',CONTENT_TYPE)
+        req.add_header('X-Station',self.station)
+        req.add_header('X-Batch',name[:-len(SPOOL_SUFFIX)])
+        try:
+            with urllib.request.urlopen(req,timeout=HTTP_TIMEOUT_SECONDS) as rsp:
+                status = rsp.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except (urllib.error.URLError,http.client.HTTPException,OSError,ValueError) as e:
+            # A garbled response shouldn't take the server down either
+            raise UplinkError(type(e).__name__ + ': ' + str(e))
+        if 400 <= status <= 499 and status not in RETRY_STATUS:
+            raise UplinkRejected('HTTP ' + str(status))
+        if status < 200 or status > 299:
+            raise UplinkError('HTTP ' + str(status))
+        os.remove(path)
+
+    # Blocking, run in a thread
+    def reject(self,name):
+        rejected_dir = os.path.join(self.spool_dir,REJECTED_DIR)
+        os.makedirs(rejected_dir,mode=0o755,exist_ok=True)
+        os.replace(os.path.join(self.spool_dir,name),os.path.join(rejected_dir,name))
+        files = sorted(os.listdir(rejected_dir))
+        while len(files) > MAX_REJECTED_FILES:
+            os.remove(os.path.join(rejected_dir,files.pop(0)))
+
+    # Called on shutdown, from the trio thread
+    def flush(self):
+        if len(self.rows) > 0:
+            rows = list(self.rows)
+            try:
+                self.write_block(self.make_block(rows))
+            except OSError as e:
+                log.error('[UplinkExporter:flush] Lost %d rows: %s',len(rows),str(e))
+                return
+            self.rows_written(rows)
+
+    async def back_off(self,reason):
+        self.failures += 1
+        # Jitter so a fleet coming back online doesn't retry in step
+        delay = self.backoff * random.uniform(0.5,1.0)
+        log.warning('[UplinkExporter:run] %s, retrying in %.0f seconds',reason,delay)
+        self.backoff = min(self.backoff * 2,RETRY_MAX_SECONDS)
+        await trio.sleep(delay)
+
+    # Disk errors are retried like network errors rather than allowed to
+    # take the server down with them
+    async def run(self):
+        log.info('Uplink to ' + self.url)
+        while True:
+            if True == self.flush_due():
+                rows = list(self.rows)
+                try:
+                    await trio.to_thread.run_sync(self.write_block,self.make_block(rows))
+                except OSError as e:
+                    await self.back_off('Spooling failed (' + str(e) + ')')
+                    continue
+                self.rows_written(rows)
+            try:
+                files = await trio.to_thread.run_sync(self.spool_files)
+            except OSError as e:
+                await self.back_off('Reading the spool failed (' + str(e) + ')')
+                continue
+            if 0 == len(files):
+                await trio.sleep(IDLE_SECONDS)
+                continue
+            try:
+                await trio.to_thread.run_sync(self.upload,files[0])
+            except UplinkRejected as e:
+                log.error('[UplinkExporter:run] Batch %s rejected (%s), moved to %s',files[0],str(e),REJECTED_DIR)
+                try:
+                    await trio.to_thread.run_sync(self.reject,files[0])
+                except OSError as e:
+                    await self.back_off('Moving a rejected batch failed (' + str(e) + ')')
+            except UplinkError as e:
+                await self.back_off('Upload failed (' + str(e) + ')')
+            except OSError as e:
+                await self.back_off('Reading a batch failed (' + str(e) + ')')
+            else:
+                self.uploaded += 1
+                self.backoff = RETRY_MIN_SECONDS
+
+
+# Stand-in endpoint for testing
+def serve(port):
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length',0)))
+            try:
+                timestamps,columns,digits = reading_codec.decode_block(body)
+            except reading_codec.CodecError as e:
+                self.send_response(400)
+                self.end_headers()
+                print('Bad batch: ' + str(e))
+                return
+            print('%s batch %s: %d bytes, %d rows, %d columns' % (self.headers.get('X-Station'),self.headers.get('X-Batch'),len(body),len(timestamps),len(columns)))
+            for name,values in columns.items():
+                print('    %s: %s' % (name,values))
+            self.send_response(204)
+            self.end_headers()
+
+    http.server.HTTPServer(('',port),Handler).serve_forever()
+
+
+if '__main__' == __name__:
+    import argparse
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--serve',type=int,metavar='PORT',required=True,help='Run a stand-in upload endpoint on PORT')
+    args = arg_parser.parse_args()
+    serve(args.serve)